@@ -0,0 +1,167 @@
+"""Benchmark the whole pipeline on synthetic datasets
+
+For each size, sample a dataset from a known SimpleModel, then time each
+stage: writing and reading the dataset, counting transitions, training
+simple and general models, validation, cross-validation and life curves.
+The peak resident memory of the process is recorded after each stage,
+and trained models are compared with the true one.
+
+Each size runs in its own process, so that peaks of memory are separated.
+Datasets larger than --stream-above rows are read by stream_csv.
+
+Usage: python benchmarks/bench_pipeline.py [--rows 10k,1m,10m]
+           [--states N] [--noise P] [--xlsx] [--json result.json]
+"""
+from argparse import ArgumentParser, SUPPRESS
+from contextlib import contextmanager
+from io import StringIO
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from synthetic import true_model, format_config, sample, write_csv, \
+    write_xlsx, parse_rows  # noqa: E402
+from deterior.dataset import DataSetReader, TransitionCounts  # noqa: E402
+from deterior.training import build_simple_model, \
+    build_general_model  # noqa: E402
+from deterior.evaluation import validate_model, cross_validate  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # unavailable on Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    """Return peak resident memory of this process in bytes, or 0."""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Stages:
+    """Record wall time and peak memory of stages."""
+    def __init__(self) -> None:
+        self.results = []
+
+    @contextmanager
+    def __call__(self, name: str):
+        start = perf_counter()
+        yield
+        self.results.append({'stage': name,
+                             'seconds': perf_counter() - start,
+                             'peak_rss': peak_rss()})
+
+
+def run_one(args) -> dict:
+    """Run all stages on a dataset of `args.run_one` rows."""
+    rows, n = args.run_one, args.states
+    model = true_model(n, args.seed)
+    stage = Stages()
+    accuracy = {}
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'dataset.csv')
+        with stage('sample'):
+            columns = sample(model, rows // args.inspections,
+                             args.inspections, time_unit=args.unit,
+                             noise=args.noise, seed=args.seed)
+        with stage('write csv'):
+            write_csv(path, n, *columns)
+        del columns
+        reader = DataSetReader(StringIO(format_config(args.unit)))
+        with open(path, newline='', encoding='utf-8') as f:
+            if rows > args.stream_above:
+                with stage('stream_csv'):
+                    records, _ = reader.stream_csv(f)
+            else:
+                with stage('load_csv'):
+                    records, _ = reader.load_csv(f)
+        if args.xlsx:
+            xlsx = os.path.join(tmpdir, 'dataset.xlsx')
+            write_xlsx(xlsx, n, *sample(
+                model, rows // args.inspections, args.inspections,
+                time_unit=args.unit, noise=args.noise, seed=args.seed))
+            with open(xlsx, 'rb') as f, stage('load_xls'):
+                reader.load_xls(f)
+
+    with stage('count transitions'):
+        counts = records if isinstance(records, TransitionCounts) \
+            else TransitionCounts.from_records(n, records)
+    with stage('build simple'):
+        simple, _ = build_simple_model(n, counts)
+    accuracy['simple'] = float(np.abs(simple.probs - model.probs).max())
+    with stage('build general'):
+        general, _ = build_general_model(n, counts)
+    accuracy['general'] = float(
+        np.abs(general.dense() - model.dense()).max())
+    with stage('validate'):
+        result = validate_model(simple, counts)
+    accuracy['validate error %'] = float(result.err)
+    if not isinstance(records, TransitionCounts):
+        with stage('cross validate k=5'):
+            result = cross_validate(n, records, 5, seed=args.seed)
+        accuracy['cross error %'] = float(result.err)
+    with stage('simulate curves'):
+        for _ in range(100):
+            simple.simulate_curves(None, 0, 1000, 1)
+    return {'rows': rows, 'stages': stage.results, 'accuracy': accuracy}
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', default='10k,1m,10m',
+                        help='comma-separated sizes of datasets')
+    parser.add_argument('--states', type=int, default=5)
+    parser.add_argument('--inspections', type=int, default=5)
+    parser.add_argument('--unit', type=int, default=30)
+    parser.add_argument('--noise', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stream-above', type=parse_rows, default=2000_000)
+    parser.add_argument('--xlsx', action='store_true',
+                        help='also write and read .xlsx datasets (slow)')
+    parser.add_argument('--json', help='save results as JSON file')
+    parser.add_argument('--run-one', type=parse_rows, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args)))
+        return
+
+    options = ['--states', args.states, '--inspections', args.inspections,
+               '--unit', args.unit, '--noise', args.noise,
+               '--seed', args.seed, '--stream-above', args.stream_above]
+    if args.xlsx:
+        options.append('--xlsx')
+    results = []
+    for rows in [parse_rows(r) for r in args.rows.split(',')]:
+        proc = subprocess.run(
+            [sys.executable, __file__, '--run-one', str(rows)] +
+            [str(o) for o in options],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            print(f'{rows} rows: failed with status {proc.returncode}',
+                  file=sys.stderr)
+            continue
+        result = json.loads(proc.stdout.splitlines()[-1])
+        results.append(result)
+        print(f'\n{rows:,} rows')
+        print(f'  {"Stage":<20} {"Time":>9} {"Peak RSS":>10}')
+        for s in result['stages']:
+            print(f'  {s["stage"]:<20} {s["seconds"]:8.3f}s '
+                  f'{s["peak_rss"] / 2 ** 20:8.0f}MB')
+        print('  Accuracy: ' + ', '.join(
+            f'{k} {v:.4g}' for k, v in result['accuracy'].items()))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark latency of queries to "deterior serve"
+
+Start the server on a Unix socket with a bundle of models, then send
+/simulate queries of a batch of assets each on one keep-alive connection.
+
+Usage: python benchmarks/bench_serve.py [--models N] [--batch B]
+                                        [--queries Q]
+"""
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+import json
+import os
+import socket
+import subprocess
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from deterior.models import SimpleModel, dump_bundle  # noqa: E402
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTPConnection over a Unix domain socket."""
+    def __init__(self, path: str) -> None:
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def query(conn: HTTPConnection, path: str, obj: dict) -> dict:
+    conn.request('POST', path, json.dumps(obj),
+                 {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    result = json.loads(response.read().decode('utf-8'))
+    if response.status != 200:
+        raise RuntimeError(result['error'])
+    return result
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--models', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+    rng = np.random.RandomState(0)
+
+    with TemporaryDirectory() as tmpdir:
+        models = {f'S{i}': SimpleModel(rng.uniform(0.01, 0.2, 4))
+                  for i in range(args.models)}
+        with open(os.path.join(tmpdir, 'bundle.bin'), 'wb') as f:
+            dump_bundle(models, f, binary=True)
+        sock = os.path.join(tmpdir, 'deterior.sock')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'deterior', 'serve', tmpdir,
+             '--unix', sock],
+            cwd=os.path.join(os.path.dirname(__file__), '..'))
+        try:
+            conn = UnixHTTPConnection(sock)
+            while conn.sock is None:
+                try:
+                    conn.connect()
+                except (FileNotFoundError, ConnectionRefusedError):
+                    sleep(0.05)
+            segments = list(models)
+            query(conn, '/simulate', {'model': 'bundle.bin',
+                                      'segment': segments[0]})
+            latencies = []
+            for i in range(args.queries):
+                segment = segments[i % len(segments)]
+                states = rng.randint(0, 5, args.batch)
+                times = rng.randint(0, 100, args.batch)
+                start = perf_counter()
+                result = query(conn, '/simulate', {
+                    'model': 'bundle.bin', 'segment': segment,
+                    'states': states.tolist(), 'times': times.tolist(),
+                })
+                latencies.append(perf_counter() - start)
+                if i % 100 == 0:
+                    expect = models[segment].powers(times)[
+                        np.arange(args.batch), states]
+                    if not np.allclose(result['probs'], expect):
+                        print('Result differs from the model',
+                              file=sys.stderr)
+                        sys.exit(1)
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = np.array(latencies) * 1000
+    print(f'{args.queries} queries of {args.batch} assets on '
+          f'{args.models} models')
+    print(f'Latency: median {np.median(latencies):.3f}ms, '
+          f'p99 {np.percentile(latencies, 99):.3f}ms')
+    rate = args.queries * args.batch / latencies.sum() * 1000
+    print(f'Throughput: {rate:,.0f} assets/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark startup time of deterior tasks
+
+Run each task as a new process with `python -X importtime`, report the
+wall time and the time spent on imports, and check that it doesn't import
+modules it doesn't use. Exit with status 1 if any task does, so it can
+guard against regressions.
+
+Usage: python benchmarks/bench_startup.py [--repeat N]
+"""
+from argparse import ArgumentParser
+from datetime import date, timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import subprocess
+import sys
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from deterior.models import SimpleModel  # noqa: E402
+
+# Heavy modules that none of the tasks below should import.
+SLOW = ['matplotlib', 'openpyxl', 'asyncio']
+
+
+def write_dataset(path: str, assets: int = 200) -> None:
+    """Write 5 inspections of each asset, which deteriorates slowly."""
+    rng = np.random.RandomState(0)
+    start = date(2000, 1, 1)
+    with open(path, 'w') as f:
+        f.write('ID,State,Time\n')
+        for i in range(assets):
+            states = np.minimum(np.cumsum(rng.rand(5) < 0.3), 4)
+            days = np.sort(rng.randint(0, 7000, 5))
+            for state, day in zip(states, days):
+                day = start + timedelta(days=int(day))
+                f.write(f'A{i},{state},{day}\n')
+
+
+def run(args: [str]) -> (float, float, [str]):
+    """Run deterior with `args`.
+    Return wall time, time of imports and imported modules."""
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-m', 'deterior'] + args,
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = perf_counter() - start
+    if proc.returncode != 0:
+        print(proc.stderr, file=sys.stderr)
+        raise RuntimeError(f'deterior {" ".join(args)} failed')
+    modules, total = [], 0
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if not name.startswith('  ') and cumulative.strip().isdigit():
+                total += int(cumulative)  # top-level import
+            modules.append(name.strip())
+    return elapsed, total / 1e6, modules
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        dataset = os.path.join(tmpdir, 'dataset.csv')
+        model = os.path.join(tmpdir, 'model.json')
+        write_dataset(dataset)
+        with open(model, 'w') as f:
+            SimpleModel([0.1, 0.1, 0.1, 0.1]).dump(f)
+        output = os.path.join(tmpdir, 'output')
+        unused = ['scipy', 'multiprocessing']
+        tasks = [
+            ('--help', ['--help'], ['numpy'] + unused),
+            ('validate', ['--no-cache', 'validate', model, dataset],
+             unused),
+            ('forecast', ['--no-cache', 'forecast', model, dataset,
+                          '-t', '10'], unused),
+            ('lifecurve -e', ['lifecurve', model, '--to', '50',
+                              '-e', f'{output}.csv'], unused),
+            ('build', ['--no-cache', 'build', dataset, f'{output}.json'],
+             []),
+        ]
+
+        failed = False
+        print(f'{"Task":<14} {"Wall":>8} {"Imports":>8}')
+        for name, task_args, slow in tasks:
+            run(task_args)  # warm up, write bytecode caches
+            times = [run(task_args) for _ in range(args.repeat)]
+            elapsed = min(t[0] for t in times)
+            imports = min(t[1] for t in times)
+            print(f'{name:<14} {elapsed * 1000:6.0f}ms '
+                  f'{imports * 1000:6.0f}ms')
+            modules = times[0][2]
+            for prefix in SLOW + slow:
+                found = [m for m in modules
+                         if m == prefix or m.startswith(prefix + '.')]
+                if found:
+                    failed = True
+                    print(f'  imports {prefix}, which it does not need',
+                          file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
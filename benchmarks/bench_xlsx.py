@@ -0,0 +1,74 @@
+"""Benchmark reading .xlsx datasets
+
+Compare the openpyxl-based ExcelReader against XlsxColumnReader, which
+streams the sheet XML and keeps only the configured columns.
+
+Usage: python benchmarks/bench_xlsx.py [--rows N] [--columns M]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import os
+import sys
+import numpy as np
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from deterior.dataset import DataSetReader  # noqa: E402
+
+
+def write_workbook(path: str, rows: int, columns: int) -> None:
+    """Write a dataset with `columns` unrelated columns besides ID, State
+    and Time. Each asset is inspected about 5 times."""
+    rng = np.random.RandomState(0)
+    book = Workbook(write_only=True)
+    sheet = book.create_sheet()
+    sheet.append(['ID', 'State', 'Time'] +
+                 [f'Extra {i}' for i in range(columns)])
+    start = datetime(2000, 1, 1)
+    assets = rng.randint(0, max(rows // 5, 1), rows)
+    days = rng.randint(0, 7000, rows)
+    states = rng.randint(0, 5, rows)
+    for asset, day, state in zip(assets, days, states):
+        extra = [f'text {asset % 97}', float(day) / 7, int(day)] * columns
+        sheet.append([f'A{asset}', int(state),
+                      start + timedelta(days=int(day))] + extra[:columns])
+    book.save(path)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--columns', type=int, default=30)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'dataset.xlsx')
+        print(f'Writing {args.rows} rows x {args.columns + 3} columns...')
+        write_workbook(path, args.rows, args.columns)
+        reader = DataSetReader()
+
+        start = perf_counter()
+        with open(path, 'rb') as f:
+            columns = reader._openpyxl_columns(f, reader.columns)
+            expect, _ = reader._columns_to_records(*reader._clean(columns))
+        openpyxl_time = perf_counter() - start
+
+        start = perf_counter()
+        with open(path, 'rb') as f:
+            actual, _ = reader.load_xls(f)
+        stream_time = perf_counter() - start
+
+    if not np.array_equal(np.sort(expect), np.sort(actual)):
+        print('Records differ between two readers', file=sys.stderr)
+        sys.exit(1)
+    print(f'ExcelReader:      {openpyxl_time:.2f}s '
+          f'({args.rows / openpyxl_time:,.0f} rows/s)')
+    print(f'XlsxColumnReader: {stream_time:.2f}s '
+          f'({args.rows / stream_time:,.0f} rows/s)')
+    print(f'Speed-up:         {openpyxl_time / stream_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Synthetic inspection datasets
+
+Sample inspection histories of assets from a known model, and write them
+as .csv or .xlsx datasets in the default format of DataSetReader (columns
+ID, State and Time, dates as %Y-%m-%d), to be read with the time unit
+used in sampling. As the true model is known, models trained on them can
+be checked for accuracy.
+
+Usage: python benchmarks/synthetic.py output.csv [--rows N] [--states N]
+           [--inspections N] [--interval DAYS] [--spread CV]
+           [--unit DAYS] [--noise P] [--seed SEED]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from deterior.models import Model, SimpleModel  # noqa: E402
+
+START = np.datetime64('2000-01-01')
+
+
+def true_model(n_state: int, seed: int = 0) -> SimpleModel:
+    """Return a SimpleModel with random probabilities of deterioration."""
+    rng = np.random.RandomState(seed)
+    return SimpleModel(rng.uniform(0.02, 0.15, n_state - 1))
+
+
+def format_config(time_unit: int) -> str:
+    """Return the dataset format config to read sampled datasets."""
+    return f'[Time]\nunit = {time_unit}d\n'
+
+
+def sample(model: Model, assets: int, inspections: int = 5,
+           interval: float = 365, spread: float = 0.5,
+           time_unit: int = 30, noise: float = 0, seed: int = 0) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+    """Sample `inspections` of each of `assets`, all start in state 0.
+
+    Days between inspections follow a gamma distribution with mean
+    `interval` and coefficient of variation `spread`. A recorded state
+    is off by one from the true state with probability `noise`.
+    Return asset numbers, recorded states and days since 2000-01-01 of
+    inspections, ordered by asset and then time.
+    """
+    rng = np.random.RandomState(seed)
+    n = model.n_state
+    if spread > 0:
+        gaps = rng.gamma(spread ** -2, interval * spread ** 2,
+                         (assets, inspections - 1))
+    else:
+        gaps = np.full((assets, inspections - 1), float(interval))
+    gaps = np.maximum(np.round(gaps), 1).astype(int)
+    days = np.zeros((assets, inspections), dtype=int)
+    days[:, 1:] = np.cumsum(gaps, axis=1)
+    days += rng.randint(0, 3650, (assets, 1))
+    steps = np.round(gaps / time_unit).astype(int)
+
+    states = np.zeros((assets, inspections), dtype=int)
+    for k in range(1, inspections):
+        uniques, index = np.unique(steps[:, k - 1], return_inverse=True)
+        cum = np.cumsum(model.powers(uniques), axis=2)
+        cum = cum[index, states[:, k - 1]]
+        states[:, k] = np.minimum(
+            (rng.rand(assets, 1) > cum).sum(axis=1), n - 1)
+    if noise > 0:
+        shift = np.where(rng.rand(assets, inspections) < 0.5, -1, 1)
+        shift[rng.rand(assets, inspections) >= noise] = 0
+        states = np.clip(states + shift, 0, n - 1)
+
+    ids = np.repeat(np.arange(assets), inspections)
+    return ids, states.reshape(-1), days.reshape(-1)
+
+
+def _state_names(n_state: int) -> [str]:
+    """Names of states, zero-padded to be sorted in order."""
+    width = len(str(n_state - 1))
+    return [f'{s:0{width}d}' for s in range(n_state)]
+
+
+def write_csv(path: str, n_state: int, ids: np.ndarray, states: np.ndarray,
+              days: np.ndarray, chunk_size: int = 1 << 18) -> None:
+    """Write sampled inspections as a .csv dataset."""
+    names = _state_names(n_state)
+    with open(path, 'w', newline='') as f:
+        f.write('ID,State,Time\n')
+        for start in range(0, len(ids), chunk_size):
+            end = start + chunk_size
+            dates = (START + days[start:end]).astype(str)
+            f.writelines(
+                f'A{i},{names[s]},{d}\n' for i, s, d in
+                zip(ids[start:end].tolist(), states[start:end].tolist(),
+                    dates.tolist()))
+
+
+def write_xlsx(path: str, n_state: int, ids: np.ndarray,
+               states: np.ndarray, days: np.ndarray) -> None:
+    """Write sampled inspections as a .xlsx dataset. It's slow, use it
+    with small datasets only."""
+    from openpyxl import Workbook
+    names = _state_names(n_state)
+    book = Workbook(write_only=True)
+    sheet = book.create_sheet()
+    sheet.append(['ID', 'State', 'Time'])
+    start = datetime(2000, 1, 1)
+    for i, s, d in zip(ids.tolist(), states.tolist(), days.tolist()):
+        sheet.append([f'A{i}', names[s], start + timedelta(days=d)])
+    book.save(path)
+
+
+def parse_rows(text: str) -> int:
+    """Parse numbers like 10k, 1m and 2500."""
+    scale = {'k': 1000, 'm': 1000_000}.get(text[-1:].lower(), 1)
+    return int(float(text.rstrip('kKmM')) * scale)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('output', help='.csv or .xlsx file to write')
+    parser.add_argument('--rows', type=parse_rows, default=10_000)
+    parser.add_argument('--states', type=int, default=5)
+    parser.add_argument('--inspections', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=365)
+    parser.add_argument('--spread', type=float, default=0.5)
+    parser.add_argument('--unit', type=int, default=30)
+    parser.add_argument('--noise', type=float, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    model = true_model(args.states, args.seed)
+    columns = sample(model, args.rows // args.inspections, args.inspections,
+                     args.interval, args.spread, args.unit, args.noise,
+                     args.seed)
+    if args.output.endswith('.xlsx'):
+        write_xlsx(args.output, args.states, *columns)
+    else:
+        write_csv(args.output, args.states, *columns)
+    print(f'{len(columns[0])} inspections written to {args.output}')
+    print(f'True probabilities: {model.probs}')
+    print(f'Read it with format config:\n{format_config(args.unit)}')
+
+
+if __name__ == '__main__':
+    main()
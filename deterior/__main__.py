@@ -3,10 +3,9 @@
 Parsing command line arguments and pass them to `tasks` modules.
 """
 from argparse import ArgumentParser, FileType, Namespace
+import json
 import sys
 
-from . import tasks
-
 
 def _get_args() -> Namespace:
     parser = ArgumentParser(
@@ -19,6 +18,36 @@ def _get_args() -> Namespace:
         type=FileType('r', encoding='utf-8'),
         help='specify the format configuration for input dataset',
     )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help='where to cache parsed datasets, default to '
+             '$XDG_CACHE_HOME/deterior or ~/.cache/deterior'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='always parse the dataset, neither read nor write the cache'
+    )
+    parser.add_argument(
+        '--read-jobs',
+        metavar='N', type=int, default=0,
+        help='the number of processes to parse multiple dataset files in '
+             'parallel, default to 0 for the number of CPUs'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='metrics.json',
+        type=FileType('w', encoding='utf-8'),
+        help='save wall time and metrics (e.g. rows per second, loss '
+             'evaluations) of each stage of the task as JSON file'
+    )
+    parser.add_argument(
+        '--cprofile',
+        metavar='DIR',
+        help='profile each stage of the task with cProfile, and save the '
+             'stats as .prof files into DIR'
+    )
     subparsers = parser.add_subparsers(
         title='tasks',
         dest='task',
@@ -27,14 +56,31 @@ def _get_args() -> Namespace:
 
     model = dict(
         metavar='model.json',
-        type=FileType(encoding='utf-8'),
-        help="the input model"
+        type=FileType('rb'),
+        help="the input model, either in json or bin format"
+    )
+    segment = dict(
+        metavar='NAME',
+        help='name of the model to use, if the input model is a bundle built '
+             'by "build --group-by"'
     )
     dataset = dict(
         metavar='dataset.csv',
-        type=FileType('rb'),
-        help='a comma-separated values (.csv) or Microsoft Excel (.xlsx) file '
-             'that contains inspection records'
+        nargs='+',
+        help='comma-separated values (.csv), gzip-compressed (.csv.gz) or '
+             'Microsoft Excel (.xlsx) files, or globs of them like '
+             '"data/*.csv.gz", that contain inspection records'
+    )
+    stream = dict(
+        action='store_true',
+        help='read .csv dataset in streaming mode, which spills inspections '
+             'to temporary files to handle datasets larger than memory'
+    )
+    partitions = dict(
+        metavar='N', type=int,
+        help='the number of temporary files of --stream, each of which is '
+             'read into memory at once, default to one for every 16MB of '
+             'input'
     )
 
     build = subparsers.add_parser(
@@ -45,16 +91,135 @@ def _get_args() -> Namespace:
     build.add_argument(
         'model',
         metavar='output.json',
-        type=FileType('w', encoding='utf-8'),
+        type=FileType('wb'),
         help='where to save the model'
     )
     build.add_argument(
         '-t', '--output-type',
-        choices=['json', 'csv'],
+        choices=['json', 'bin', 'csv'],
+        default='json',
+        help='format of output model file. "json" and "bin" can be used on '
+             'other tasks later, whereas "csv" is output-only '
+             'human-readable format. "bin" is a compact binary format '
+             'that loads fast, for large models and bundles.'
+    )
+    build.add_argument('--stream', **stream)
+    build.add_argument('--partitions', **partitions)
+    build.add_argument(
+        '-m', '--model',
+        dest='model_type',
+        choices=['simple', 'general'],
+        default='simple',
+        help='"simple" model changes at most to the next state in each step. '
+             '"general" model is fitted by maximum likelihood, and allows '
+             'changes within --max-deteriorate and --max-improve states. '
+             'Default to "simple".'
+    )
+    build.add_argument(
+        '--max-deteriorate',
+        metavar='N', type=int, default=1,
+        help='for general model, the maximum number of states to deteriorate '
+             'in one step, default to 1'
+    )
+    build.add_argument(
+        '--max-improve',
+        metavar='N', type=int, default=0,
+        help='for general model, the maximum number of states to improve in '
+             'one step (e.g. by maintenance), default to 0'
+    )
+    build.add_argument(
+        '-g', '--group-by',
+        metavar='COLUMN',
+        help='build one model for each distinct value of COLUMN, and save '
+             'them as a bundle of models'
+    )
+    build.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int, default=1,
+        help='the number of processes to train models of --group-by, or '
+             'to search the parameters and --bootstrap one simple model in '
+             'parallel, 0 for the number of CPUs, default to 1.'
+    )
+    build.add_argument(
+        '--starts',
+        metavar='N', type=int, default=20,
+        help='for simple model, the number of random points to search '
+             'from again if the first search ends with a large loss, '
+             'default to 20'
+    )
+    build.add_argument(
+        '--tol',
+        metavar='TOL', type=float,
+        help='the relative tolerance of loss to stop training, default to '
+             'about 2e-9 for simple model, 1e-8 for general model'
+    )
+    build.add_argument(
+        '--seed',
+        metavar='SEED', type=int,
+        help='random seed of the points to search from and of --bootstrap, '
+             'makes results reproducible'
+    )
+    build.add_argument(
+        '--bootstrap',
+        metavar='N', type=int, default=0,
+        help='for simple model, refit it on N bootstrap replicates of the '
+             'records on -j processes, and save percentile bands of its '
+             'parameters and life curves as NAME.bands.json next to the '
+             'output model'
+    )
+    build.add_argument(
+        '--level',
+        metavar='PERCENT', type=float, default=95,
+        help='confidence level of --bootstrap bands, default to 95'
+    )
+    build.add_argument(
+        '--curve-to',
+        metavar='T', type=int, default=100,
+        help='end time of life curves of --bootstrap bands, default to 100'
+    )
+
+    update = subparsers.add_parser(
+        'update',
+        help='update a simple model with a new batch of inspections, '
+             'without reading the earlier batches again'
+    )
+    update.add_argument(
+        'history',
+        metavar='history.npz',
+        help='the latest inspection of each asset and the counts of '
+             'transitions of all batches so far, created by the first '
+             'update and updated by each update'
+    )
+    update.add_argument('dataset', **dataset)
+    update.add_argument(
+        'model',
+        metavar='output.json',
+        type=FileType('wb'),
+        help='where to save the model'
+    )
+    update.add_argument(
+        '-t', '--output-type',
+        choices=['json', 'bin', 'csv'],
         default='json',
-        help='format of output model file. "json" can be used on other '
-             'tasks later, whereas "csv" is output-only human-readable '
-             'format.'
+        help='format of output model file, see "build"'
+    )
+    update.add_argument(
+        '--starts',
+        metavar='N', type=int, default=20,
+        help='the number of random points to search from again if the '
+             'first search ends with a large loss, default to 20'
+    )
+    update.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int, default=1,
+        help='the number of processes to search in parallel, 0 for the '
+             'number of CPUs, default to 1.'
+    )
+    update.add_argument(
+        '--seed',
+        metavar='SEED', type=int,
+        help='random seed of the points to search from, makes results '
+             'reproducible'
     )
 
     validate = subparsers.add_parser(
@@ -63,7 +228,16 @@ def _get_args() -> Namespace:
              'inspection records'
     )
     validate.add_argument('model', **model)
+    validate.add_argument('--segment', **segment)
     validate.add_argument('dataset', **dataset)
+    validate.add_argument('--stream', **stream)
+    validate.add_argument('--partitions', **partitions)
+    validate.add_argument(
+        '--per-gap',
+        action='store_true',
+        help='also print the error of records of each time gap, one line '
+             'for each distinct gap'
+    )
 
     cross = subparsers.add_parser(
         'cross',
@@ -75,13 +249,89 @@ def _get_args() -> Namespace:
         help='the number of subsamples in k-fold cross-validation, '
              'default to 5.'
     )
+    cross.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int, default=1,
+        help='the number of processes to train folds in parallel, '
+             '0 for the number of CPUs, default to 1.'
+    )
+    cross.add_argument(
+        '--seed',
+        metavar='SEED', type=int,
+        help='random seed to shuffle records, makes results reproducible'
+    )
     cross.add_argument('dataset', **dataset)
 
+    sweep = subparsers.add_parser(
+        'sweep',
+        help='rank time units and binnings of states by k-fold '
+             'cross-validation of the simple model'
+    )
+    sweep.add_argument('dataset', **dataset)
+    sweep.add_argument(
+        '-u', '--units',
+        metavar='UNITS',
+        help='comma-separated time units to try, like "1m,3m,6m,1y", '
+             'default to the unit of the dataset format'
+    )
+    sweep.add_argument(
+        '-b', '--bins',
+        metavar='SCHEME', action='append',
+        help='binning of states to try besides the original states, like '
+             '"0+1,2,3+4" to merge states 0, 1 and states 3, 4. Can be '
+             'given multiple times.'
+    )
+    sweep.add_argument(
+        '-k',
+        metavar='K', type=int, default=5,
+        help='the number of subsamples in k-fold cross-validation, '
+             'default to 5.'
+    )
+    sweep.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int, default=1,
+        help='the number of processes to train folds of all variants in '
+             'parallel, 0 for the number of CPUs, default to 1.'
+    )
+    sweep.add_argument(
+        '--seed',
+        metavar='SEED', type=int,
+        help='random seed to shuffle records, makes results reproducible'
+    )
+
+    forecast = subparsers.add_parser(
+        'forecast',
+        help='forecast states of all assets from their latest inspections'
+    )
+    forecast.add_argument('model', **model)
+    forecast.add_argument('--segment', **segment)
+    forecast.add_argument('dataset', **dataset)
+    forecast.add_argument(
+        '-t', '--horizon',
+        metavar='T', type=int, required=True,
+        help='how long to forecast after the reference date, in the time '
+             'unit of the model, or of the dataset format for models '
+             'saved without it'
+    )
+    forecast.add_argument(
+        '--at',
+        metavar='YYYY-MM-DD',
+        help='the reference date, default to the latest inspection date in '
+             'the dataset'
+    )
+    forecast.add_argument(
+        '-o', '--output',
+        metavar='output.csv',
+        type=FileType('wb'),
+        help='save the forecast state probabilities of each asset as CSV file'
+    )
+
     lifecurve = subparsers.add_parser(
         'lifecurve',
         help='plot life curve for a given model',
     )
     lifecurve.add_argument('model', **model)
+    lifecurve.add_argument('--segment', **segment)
     lifecurve.add_argument(
         '-s', '--state',
         metavar='N', type=int, default=0,
@@ -109,6 +359,45 @@ def _get_args() -> Namespace:
         type=FileType('wb'),
         help='save figure as image file instead of showing on pop-up window'
     )
+    lifecurve.add_argument(
+        '-e', '--export',
+        metavar='curves.csv',
+        type=FileType('wb'),
+        help='save curves of all initial states as a .csv table or a .npy '
+             'array of shape (initial states, times, states), instead of '
+             'plotting'
+    )
+
+    serve = subparsers.add_parser(
+        'serve',
+        help='serve queries on models over HTTP, see deterior/server.py for '
+             'the API'
+    )
+    serve.add_argument(
+        'directory',
+        help='directory of models, which are named by their relative paths '
+             'in queries'
+    )
+    serve.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='address to listen on, default to 127.0.0.1'
+    )
+    serve.add_argument(
+        '-p', '--port',
+        metavar='PORT', type=int, default=8080,
+        help='TCP port to listen on, default to 8080'
+    )
+    serve.add_argument(
+        '--unix',
+        metavar='PATH',
+        help='listen on Unix domain socket PATH instead of TCP port'
+    )
+    serve.add_argument(
+        '--cache-size',
+        metavar='N', type=int, default=16,
+        help='the number of model files to keep loaded, default to 16'
+    )
 
     args = parser.parse_args()
     if not args.task:
@@ -119,8 +408,17 @@ def _get_args() -> Namespace:
 
 def main() -> None:
     args = _get_args()
+    profiler = None
+    if args.profile or args.cprofile:
+        from . import profiling
+        profiler = profiling.enable(args.cprofile)
+    from . import tasks  # after parsing, so --help doesn't import numpy
     task = getattr(tasks, args.task)
     task(args)
+    if args.profile:
+        json.dump({'task': args.task, **profiler.to_obj()},
+                  args.profile, indent=2)
+        args.profile.close()
 
 if __name__ == '__main__':
     main()
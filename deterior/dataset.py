@@ -3,23 +3,111 @@
 This module is used to read inspection records from files.
 Pro-processing of data is also done here.
 """
-from collections import namedtuple, defaultdict, OrderedDict
-from csv import DictReader
-from datetime import datetime
-from typing import TextIO, BinaryIO, Dict, Set
+from collections import namedtuple, OrderedDict
+from csv import reader as csv_reader, writer as csv_writer
+from datetime import datetime, timedelta
+from hashlib import sha256
+from itertools import chain, islice
+from operator import itemgetter
+from tempfile import TemporaryDirectory
+from typing import TextIO, BinaryIO, Dict, Set, Iterator
 from configparser import ConfigParser
+from html import unescape as html_unescape
+from posixpath import join as join_path, normpath
+from xml.etree.ElementTree import iterparse
+from zipfile import BadZipFile, ZipFile
+import gzip
+import json
+import os
+import re
 import sys
-from openpyxl import load_workbook
+import numpy as np
+
+from . import __version__ as version
+from . import profiling
+from .models import TimeStates
 
 
 Record = namedtuple('Record', ['s0', 's1', 't'])
-Inspect = namedtuple('Inspect', ['id', 'state', 'date'])
+
+# Records are kept in a structured array, each row of which is a Record:
+# state `s0` changed to state `s1` after time `t`.
+RECORD_DTYPE = np.dtype([('s0', np.int16), ('s1', np.int16), ('t', np.int32)])
+Records = np.ndarray
+
+# stream_csv spills inspections into one partition for every this many
+# bytes of input by default, so that each partition fits in memory when
+# it's paired. Compressed input is assumed to expand _GZIP_RATIO times,
+# on the high side. Partitions are open at once, so there are at most
+# _MAX_PARTITIONS of them by default, and _FD_HEADROOM less than the
+# limit of open files in any case; beyond that, they grow instead.
+STREAM_PARTITION_BYTES = 16 << 20
+_GZIP_RATIO = 10
+_MAX_PARTITIONS = 1000
+_FD_HEADROOM = 32
+
+
+def as_records(records) -> Records:
+    """Convert an iterable of Record to a record array if it isn't."""
+    if isinstance(records, np.ndarray) and records.dtype == RECORD_DTYPE:
+        return records
+    return np.array([tuple(r) for r in records], dtype=RECORD_DTYPE)
+
+
+class TransitionCounts:
+    """Sufficient statistics of records for training and validation.
+
+    self.times: sorted distinct times of records.
+    self.counts: (len(times) x n x n) array, counts[i, s0, s1] is the
+    number of records that state s0 changed to s1 after times[i].
+    """
+    def __init__(self, times: np.ndarray, counts: np.ndarray) -> None:
+        self.times = np.asarray(times, dtype=int)
+        self.counts = np.asarray(counts, dtype=float)
+        self.n_state = self.counts.shape[-1]
+        if self.counts.shape != (len(self.times), self.n_state, self.n_state):
+            raise ValueError('shape of counts must be (len(times) x n x n)')
+
+    @staticmethod
+    def from_records(n_state: int, records: Records,
+                     weights: np.ndarray = None) -> 'TransitionCounts':
+        """Count records by (time, s0, s1), each one `weights` times if
+        given."""
+        records = as_records(records)
+        times, index = np.unique(records['t'], return_inverse=True)
+        flat = (index * n_state + records['s0']) * n_state + records['s1']
+        size = len(times) * n_state * n_state
+        counts = np.bincount(flat, weights, minlength=size)
+        return TransitionCounts(
+            times, counts.reshape(len(times), n_state, n_state))
+
+    def __add__(self, other: 'TransitionCounts') -> 'TransitionCounts':
+        if self.n_state != other.n_state:
+            raise ValueError('cannot add counts of different states')
+        times = np.union1d(self.times, other.times)
+        counts = np.zeros([len(times), self.n_state, self.n_state])
+        counts[np.searchsorted(times, self.times)] += self.counts
+        counts[np.searchsorted(times, other.times)] += other.counts
+        return TransitionCounts(times, counts)
+
+    def __len__(self) -> int:
+        """Return the total number of records."""
+        return int(round(self.counts.sum()))
+
+    def time_states(self) -> TimeStates:
+        """Return the initial state vectors of each time."""
+        return dict(zip(self.times.tolist(), self.counts.sum(axis=2)))
+
+    def final_states(self) -> np.ndarray:
+        """Return the vector of final states."""
+        return self.counts.sum(axis=(0, 1))
 
 
 class ExcelReader:
     """Like csv.DictReader, but read MS Excel file.
     """
     def __init__(self, xlsfile: BinaryIO):
+        from openpyxl import load_workbook
         book = load_workbook(xlsfile, read_only=True)
         self.sheet = book.worksheets[0]  # use the first sheet only
         self.fieldnames = [n.value.strip() for n in self.sheet[1]]
@@ -36,8 +124,204 @@ class ExcelReader:
         return OrderedDict(zip(self.fieldnames, row))
 
 
+_NS_SHEET = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_NS_RELS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+_NS_DOC_RELS = \
+    '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+
+
+# Tags may have any namespace prefix, e.g. <x:row> and <x:c>.
+_PREFIX = r'(?:[\w.-]+:)?'
+_CELL = rf'<{_PREFIX}c r="({{}})(\d+)"([^>]*?)(?:/>|>(.*?)</{_PREFIX}c>)'
+_CELL_TYPE = re.compile(rb'\bt="(\w+)"')
+_CELL_VALUE = re.compile(rf'<{_PREFIX}v>(.*?)</{_PREFIX}v>'.encode(), re.S)
+_TEXT = re.compile(
+    rf'<{_PREFIX}t(?:\s[^>]*)?>(.*?)</{_PREFIX}t>'.encode(), re.S)
+_SHARED_STRING = re.compile(
+    rf'<{_PREFIX}si>(.*?)</{_PREFIX}si>'.encode(), re.S)
+_PHONETIC = re.compile(rf'<{_PREFIX}rPh\b.*?</{_PREFIX}rPh>'.encode(), re.S)
+_SHEET_DATA = re.compile(rf'<{_PREFIX}sheetData\b'.encode())
+_ROW_END = re.compile(rf'</{_PREFIX}row>'.encode())
+
+
+class XlsxFormatError(ValueError):
+    """The .xlsx file is valid, but not supported by XlsxColumnReader."""
+
+
+class XlsxColumnReader:
+    """Read selected columns from the first sheet of MS Excel file.
+
+    Unlike ExcelReader, it scans the sheet XML as a stream for cells of
+    the selected columns only, without creating any cell object. Cells
+    must carry their reference as the first attribute (as MS Excel,
+    LibreOffice and openpyxl write), and the first row must name all
+    columns read, otherwise XlsxFormatError is raised.
+    """
+    def __init__(self, xlsfile: BinaryIO, chunk_size: int = 1 << 22) \
+            -> None:
+        self._zip = ZipFile(xlsfile)
+        self._chunk_size = chunk_size
+        self._sheet, self._date1904 = self._first_sheet()
+        self._strings = self._shared_strings()
+
+    def _first_sheet(self) -> (str, bool):
+        """Return path of the first worksheet, and whether the workbook
+        uses 1904 date system."""
+        with self._zip.open('xl/workbook.xml') as f:
+            date1904 = False
+            for _, elem in iterparse(f):
+                if elem.tag == f'{_NS_SHEET}workbookPr':
+                    date1904 = elem.get('date1904') in ('1', 'true')
+                elif elem.tag == f'{_NS_SHEET}sheet':
+                    rid = elem.get(f'{_NS_DOC_RELS}id')
+                    break
+        with self._zip.open('xl/_rels/workbook.xml.rels') as f:
+            for _, elem in iterparse(f):
+                if elem.tag == f'{_NS_RELS}Relationship' and \
+                        elem.get('Id') == rid:
+                    target = elem.get('Target')
+                    break
+        if target.startswith('/'):
+            return target[1:], date1904
+        return normpath(join_path('xl', target)), date1904
+
+    def _shared_strings(self) -> [str]:
+        if 'xl/sharedStrings.xml' not in self._zip.namelist():
+            return []
+        data = self._zip.read('xl/sharedStrings.xml')
+        return [_text(_PHONETIC.sub(b'', si))
+                for si in _SHARED_STRING.findall(data)]
+
+    def _chunks(self) -> Iterator[bytes]:
+        """Yield pieces of sheet XML, each of which ends with a row."""
+        with self._zip.open(self._sheet) as f:
+            rest = b''
+            for chunk in iter(lambda: f.read(self._chunk_size), b''):
+                data = rest + chunk
+                end = _last_row_end(data)
+                if end < 0:
+                    rest = data
+                    continue
+                yield data[:end]
+                rest = data[end:]
+            yield rest
+
+    def read_columns(self, names: [str], date_names: [str] = ()) \
+            -> [list]:
+        """Return list of values for each of column `names`. Numbers in
+        `date_names` columns are converted to datetime. Raise
+        XlsxFormatError if any of `names` is not in the first row.
+        """
+        chunks = self._chunks()
+        header, rest = self._header(chunks)
+        letters = {name: col for col, name in header.items()}
+        missing = [name for name in names if name not in letters]
+        if missing:
+            raise XlsxFormatError(f'columns {missing} not in the first row')
+        wanted = {letters[name].encode(): i for i, name in enumerate(names)}
+        columns = [[] for _ in names]
+        dates = [name in date_names for name in names]
+        cells = re.compile(
+            _CELL.format('|'.join(c.decode() for c in wanted)).encode(),
+            re.S)
+        row, current = [None] * len(names), None
+        for chunk in chain([rest], chunks):
+            for col, line, attrs, inner in cells.findall(chunk):
+                if line != current:
+                    if current is not None:
+                        for column, value in zip(columns, row):
+                            column.append(value)
+                    row, current = [None] * len(names), line
+                i = wanted[col]
+                value = self._value(attrs, inner)
+                if dates[i] and isinstance(value, (int, float)):
+                    value = self._date(value)
+                row[i] = value
+        if current is not None:
+            for column, value in zip(columns, row):
+                column.append(value)
+        return columns
+
+    def _header(self, chunks: Iterator[bytes]) -> (Dict[str, str], bytes):
+        """Return column letters to names of the first row, and the rest
+        of XML after the first row."""
+        cells = re.compile(_CELL.format('[A-Z]+').encode(), re.S)
+        for chunk in chunks:
+            start = _SHEET_DATA.search(chunk)
+            end = start and _ROW_END.search(chunk, start.end())
+            if end is None:
+                continue  # may be a big header, wait for the next chunk
+            row = chunk[start.end():end.start()]
+            header = {col.decode(): str(self._value(attrs, inner)).strip()
+                      for col, _, attrs, inner in cells.findall(row)}
+            if not header:
+                raise XlsxFormatError('no cells found in the first row')
+            return header, chunk[end.start():]
+        raise XlsxFormatError('no rows found in the sheet')
+
+    def _value(self, attrs: bytes, inner: bytes):
+        """Return the typed value of a cell, like openpyxl."""
+        kind = _CELL_TYPE.search(attrs)
+        kind = kind.group(1) if kind else b'n'
+        if kind == b'inlineStr':
+            return _text(inner)
+        value = _CELL_VALUE.search(inner)
+        if value is None:
+            return None
+        text = value.group(1)
+        if kind == b'n':
+            if b'.' in text or b'E' in text or b'e' in text:
+                return float(text)
+            return int(text)
+        if kind == b's':
+            return self._strings[int(text)]
+        if kind == b'b':
+            return text == b'1'
+        text = _unescape(text)
+        if kind == b'd':
+            return datetime.strptime(text[:10], '%Y-%m-%d')
+        return text
+
+    def _date(self, serial: float) -> datetime:
+        """Convert serial number of Excel to datetime."""
+        if self._date1904:
+            epoch = datetime(1904, 1, 1)
+        elif serial < 60:  # Excel treats 1900 as a leap year
+            epoch = datetime(1899, 12, 31)
+        else:
+            epoch = datetime(1899, 12, 30)
+        return epoch + timedelta(days=serial)
+
+
+def _last_row_end(data: bytes) -> int:
+    """Return the end of the last closing row tag in `data`, or -1."""
+    end = len(data)
+    while True:
+        pos = data.rfind(b'row>', 0, end)
+        if pos < 0:
+            return -1
+        start = data.rfind(b'<', 0, pos)
+        if start >= 0 and _ROW_END.fullmatch(data, start, pos + 4):
+            return pos + 4
+        end = pos
+
+
+def _text(xml: bytes) -> str:
+    """Return concatenated text of all <t> elements."""
+    return ''.join(_unescape(t) for t in _TEXT.findall(xml))
+
+
+def _unescape(text: bytes) -> str:
+    text = text.decode('utf-8')
+    return html_unescape(text) if '&' in text else text
+
+
 class DataSetReader:
     """Read inspection log file according to the format config.
+
+    self.states: names of numerical states, set once a dataset is read.
+    self.segment: (column, value) to keep only rows of, after states are
+    numbered over all rows, or None. Used by load_files and latest_files.
     """
     def __init__(self, config: TextIO = None) -> None:
         cfg = ConfigParser(interpolation=None)
@@ -58,8 +342,10 @@ class DataSetReader:
         self.col_state = cfg['State']['column']
         self.col_time = cfg['Time']['column']
         self.time_format = cfg['Time']['format']
-        self.time_unit = _time_unit_to_days(cfg['Time']['unit'])
+        self.time_unit = time_unit_to_days(cfg['Time']['unit'])
         self.filters = {}
+        self.states = None
+        self.segment = None
         for key, value in cfg.items('Filters'):
             values = [v for v in value.split('\n') if v]
             if values:
@@ -67,59 +353,725 @@ class DataSetReader:
         if self.filters:
             print('Use filters:', self.filters)
 
-    def _load(self, rows) -> ([Record], int):
-        """Read records from a iterator of rows."""
-        inpsects = []
+    def fingerprint(self) -> str:
+        """Return a string that identifies how records are read."""
+        obj = {
+            'columns': self.columns,
+            'time_format': self.time_format,
+            'time_unit': self.time_unit,
+            'filters': self.filters,
+        }
+        if self.segment is not None:
+            obj['segment'] = list(self.segment)
+        return json.dumps(obj, sort_keys=True)
+
+    @property
+    def columns(self) -> [str]:
+        """Names of columns that are needed to load records."""
+        return [self.col_id, self.col_state, self.col_time,
+                *self.filters.keys()]
+
+    def _csv_rows(self, csvfile: TextIO, extras: [str] = ()) \
+            -> Iterator[tuple]:
+        """Yield tuple of needed columns, followed by `extras` columns,
+        for each row of CSV file."""
+        rows = csv_reader(csvfile)
+        header = next(rows, [])
+        # columns not in file are read as None, like csv.DictReader
+        width = len(header)
+        index = [header.index(n) if n in header else None
+                 for n in self.columns + list(extras)]
+        if None in index:
+            index = [width if i is None else i for i in index]
+            width += 1
+        pick = itemgetter(*index)
+        padding = [None] * width
         for row in rows:
-            sid = row.get(self.col_id)
-            state = row.get(self.col_state)
-            date = row.get(self.col_time)
-            if any(str(row.get(key)) not in values
-                   for key, values in self.filters.items()):
-                continue
-            if not sid:
-                raise ValueError(f'ID not found in row {rows.line_num}')
-            if not state or not date:
-                print(f'In row {rows.line_num}, {sid} '
-                      'has blank state or time, ignored.', file=sys.stderr)
-                continue
-            if isinstance(date, str):
-                date = datetime.strptime(date, self.time_format)
-            inpsects.append(Inspect(sid, state, date))
-        return self._inpsects_to_records(inpsects)
+            if not row:
+                continue  # blank line, skipped like csv.DictReader
+            if len(row) != width:
+                row = (row + padding)[:width]
+            yield pick(row)
+
+    def _csv_columns(self, csvfile: TextIO, extras: [str] = ()) -> [tuple]:
+        """Return needed columns, followed by `extras`, of CSV file."""
+        with profiling.stage('parse csv'):
+            columns = list(zip(*self._csv_rows(csvfile, extras)))
+            profiling.record(rows=len(columns[0]) if columns else 0)
+        return columns or [()] * (len(self.columns) + len(extras))
 
-    def load_csv(self, csvfile: TextIO) -> ([Record], int):
+    def _xls_columns(self, xlsfile: BinaryIO, extras: [str] = ()) -> [list]:
+        """Return needed columns, followed by `extras`, of Excel file."""
+        names = self.columns + list(extras)
+        with profiling.stage('parse xlsx'):
+            try:
+                xls = XlsxColumnReader(xlsfile)
+                columns = xls.read_columns(names, [self.col_time])
+            except XlsxFormatError:
+                xlsfile.seek(0)
+                columns = self._openpyxl_columns(xlsfile, names)
+            profiling.record(rows=len(columns[0]))
+        return columns
+
+    @staticmethod
+    def _openpyxl_columns(xlsfile: BinaryIO, names: [str]) -> [list]:
+        """Return columns `names` of Excel file read by ExcelReader,
+        which is slower but supports any workbook."""
+        columns = [[] for _ in names]
+        for row in ExcelReader(xlsfile):
+            for column, name in zip(columns, names):
+                column.append(row.get(name))
+        return columns
+
+    def _clean(self, columns: [list]) -> [np.ndarray]:
+        """Clean needed columns followed by extra columns, see
+        `_clean_columns`."""
+        with profiling.stage('clean'):
+            columns = self._clean_columns(*columns)
+            profiling.record(rows=len(columns[0]))
+        return columns
+
+    def read_files(self, paths: [str], extras: [str] = (),
+                   jobs: int = 1) -> [np.ndarray]:
+        """Read and clean needed columns, followed by `extras`, of .csv,
+        .csv.gz and .xlsx files, on `jobs` processes (all CPUs if 0).
+        Return the columns of all files concatenated in order."""
+        jobs = min(jobs or os.cpu_count(), len(paths))
+        if jobs > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with profiling.stage('parse files'), \
+                    ProcessPoolExecutor(jobs) as executor:
+                chunks = list(executor.map(
+                    self._read_file, paths, [extras] * len(paths)))
+                profiling.record(files=len(paths), jobs=jobs,
+                                 rows=sum(len(c[0]) for c in chunks))
+        else:
+            chunks = [self._read_file(path, extras) for path in paths]
+        if len(chunks) == 1:
+            return chunks[0]
+        return [np.concatenate(column) for column in zip(*chunks)]
+
+    def _read_file(self, path: str, extras: [str]) -> [np.ndarray]:
+        """Read and clean needed columns, followed by `extras`, of a file.
+        """
+        if path.endswith('.xlsx'):
+            with open(path, 'rb') as f:
+                columns = self._xls_columns(f, extras)
+        else:
+            with open_csv(path) as f:
+                columns = self._csv_columns(f, extras)
+        return self._clean(columns)
+
+    def load_csv(self, csvfile: TextIO) -> (Records, int):
         """Read records from CSV file"""
-        csv = DictReader(csvfile)
-        return self._load(csv)
+        return self._columns_to_records(
+            *self._clean(self._csv_columns(csvfile)))
 
-    def load_xls(self, xlsfile: BinaryIO) -> ([Record], int):
-        """Read records from Excel file"""
-        xls = ExcelReader(xlsfile)
-        return self._load(xls)
+    def load_files(self, paths: [str], jobs: int = 1) -> (Records, int):
+        """Read records from files, see `read_files`."""
+        return self._columns_to_records(
+            *self.read_files(paths, self._segment_column(), jobs))
+
+    def stream_csv(self, csvfile, partitions: int = None,
+                   chunk_size: int = 1 << 16) -> (TransitionCounts, int):
+        """Read CSV file, or a list of CSV files, with bounded memory,
+        return its TransitionCounts and the total number of states.
+        Files may be given as paths, which are opened one at a time.
 
-    def _inpsects_to_records(self, inspects: [Inspect]) -> ([Record], int):
-        """Return list of records and the total number of states."""
+        Inspections are spilled into `partitions` temporary files by the
+        hash of their ID, so that consecutive inspections of an asset can
+        be paired by reading one partition at a time. By default, there
+        is a partition for every STREAM_PARTITION_BYTES of input.
+        """
+        csvfiles = csvfile if isinstance(csvfile, list) else [csvfile]
+        limit = _max_partitions()
+        if partitions is None:
+            size = sum(_input_size(f) for f in csvfiles)
+            partitions = min(max(-(-size // STREAM_PARTITION_BYTES), 1),
+                             _MAX_PARTITIONS, limit)
+        elif partitions > limit:
+            print(f'Only {limit} partitions can be open at once, '
+                  f'use {limit} instead of {partitions}.', file=sys.stderr)
+            partitions = limit
         states = set()
-        id_inspects = defaultdict(list)
-        for sid, state, date in inspects:
-            states.add(state)
-            id_inspects[sid].append((state, date))
-        states = _map_states(states)
-        print(f'Found {len(states)} states in total')
-
-        records = []
-        for states_dates in id_inspects.values():
-            if len(states_dates) < 2:
+        with TemporaryDirectory(prefix='deterior-') as tmpdir:
+            paths = [os.path.join(tmpdir, f'{i}.csv')
+                     for i in range(partitions)]
+            files = [open(path, 'w', newline='', encoding='utf-8')
+                     for path in paths]
+            try:
+                writers = [csv_writer(f) for f in files]
+                total = 0
+                with profiling.stage('spill'):
+                    for f in csvfiles:
+                        if isinstance(f, str):
+                            with open_csv(f) as opened:
+                                total += self._spill(opened, writers,
+                                                     states, chunk_size)
+                        else:
+                            total += self._spill(f, writers, states,
+                                                 chunk_size)
+                    profiling.record(rows=total, partitions=partitions)
+            finally:
+                for f in files:
+                    f.close()
+
+            smap = _map_states(states)
+            print(f'Found {len(smap)} states in total')
+            self.states = sorted(smap, key=smap.get)
+            counts = TransitionCounts.from_records(len(smap), [])
+            with profiling.stage('pair partitions'):
+                for records in self._stream_transitions(paths, smap):
+                    counts += TransitionCounts.from_records(len(smap),
+                                                            records)
+                profiling.record(records=len(counts))
+        return counts, len(smap)
+
+    def _spill(self, csvfile: TextIO, writers: list, states: Set[str],
+               chunk_size: int) -> int:
+        """Write cleaned inspections of CSV file to `writers` by the hash
+        of their ID, and add their states to `states`.
+        Return the number of rows read."""
+        rows = self._csv_rows(csvfile)
+        line = 2  # line numbers of each file
+        chunk = list(islice(rows, chunk_size))
+        while chunk:
+            ids, chunk_states, days = self._clean_columns(
+                *zip(*chunk), first_line=line)
+            states.update(chunk_states)
+            for row in zip(ids, chunk_states, days.tolist()):
+                writers[hash(row[0]) % len(writers)].writerow(row)
+            line += len(chunk)
+            chunk = list(islice(rows, chunk_size))
+        return line - 2
+
+    def _stream_transitions(self, paths: [str], smap: Dict[str, int]) \
+            -> Iterator[Records]:
+        """Yield records of each partition file."""
+        for path in paths:
+            with open(path, newline='', encoding='utf-8') as f:
+                columns = list(zip(*csv_reader(f)))
+            if not columns:
                 continue
-            states_dates = sorted(states_dates)
-            for i in range(len(states_dates) - 1):
-                (s0, t0), (s1, t1) = states_dates[i], states_dates[i+1]
-                time = round((t1 - t0).days / self.time_unit)
-                if time <= 0:
-                    continue
-                records.append(Record(states[s0], states[s1], time))
-        return records, len(states)
+            ids, states, days = columns
+            states = np.array([smap[s] for s in states], dtype=int)
+            days = np.array(days, dtype=int)
+            yield self._pair(np.array(ids, dtype=object), states, days)
+
+    def load_xls(self, xlsfile: BinaryIO) -> (Records, int):
+        """Read records from Excel file"""
+        return self._columns_to_records(
+            *self._clean(self._xls_columns(xlsfile)))
+
+    def load_files_groups(self, paths: [str], group_by: str,
+                          jobs: int = 1) -> (Dict[str, Records], int):
+        """Read records from files, grouped by values of column
+        `group_by`. See `read_files` and `_group_columns`."""
+        return self._group_columns(
+            *self.read_files(paths, [group_by], jobs))
+
+    def _group_columns(self, ids: np.ndarray, states: np.ndarray,
+                       days: np.ndarray, groups: np.ndarray) \
+            -> (Dict[str, Records], int):
+        """Return ({group: records}, n_state), given cleaned columns and
+        the column to group by. States are numbered over the whole
+        dataset, so all groups have the same states."""
+        states, n_state = self._number_states(states)
+        with profiling.stage('pair'):
+            names, groups = np.unique(groups.astype(str),
+                                      return_inverse=True)
+            order = np.argsort(groups, kind='stable')
+            bounds = np.searchsorted(groups[order],
+                                     np.arange(len(names) + 1))
+            records = {}
+            for name, start, end in zip(names, bounds[:-1], bounds[1:]):
+                index = order[start:end]
+                records[name] = self._pair(ids[index], states[index],
+                                           days[index])
+            profiling.record(rows=len(ids), groups=len(records),
+                             records=sum(len(r) for r in records.values()))
+        return records, n_state
+
+    def latest_files(self, paths: [str], jobs: int = 1) \
+            -> ((np.ndarray, np.ndarray, np.ndarray), int):
+        """Read the latest inspection of each asset from files.
+        See `read_files` and `_latest_columns`."""
+        return self._latest_columns(
+            *self.read_files(paths, self._segment_column(), jobs))
+
+    def _latest_columns(self, ids: np.ndarray, states: np.ndarray,
+                        days: np.ndarray, *segments: np.ndarray) \
+            -> ((np.ndarray, np.ndarray, np.ndarray), int):
+        """Return ((ids, states, days), n_state) of cleaned columns, where
+        the arrays are the ID, numerical state and day number of the
+        latest inspection of each asset, and n_state is the total number
+        of states. See `_in_segment` for `segments`."""
+        states, n_state = self._number_states(states)
+        ids, states, days = self._in_segment(segments, ids, states, days)
+        return _latest(ids, states, days), n_state
+
+    def _segment_column(self) -> [str]:
+        """Return the extra column to read for self.segment, if any."""
+        return [] if self.segment is None else [self.segment[0]]
+
+    def _in_segment(self, segments: [np.ndarray], *columns: np.ndarray) \
+            -> [np.ndarray]:
+        """Return rows of `columns` in self.segment, given the column of
+        it read as extra in `segments`, or all rows if it's empty."""
+        if not segments:
+            return columns
+        mask = segments[0].astype(str) == self.segment[1]
+        return [column[mask] for column in columns]
+
+    def update_files(self, paths: [str], history: 'InspectionHistory',
+                     jobs: int = 1) -> Records:
+        """Add a new batch of inspections in files to `history`.
+        See `read_files` and `_update_columns`."""
+        return self._update_columns(history,
+                                    *self.read_files(paths, jobs=jobs))
+
+    def _update_columns(self, history: 'InspectionHistory',
+                        ids: np.ndarray, states: np.ndarray,
+                        days: np.ndarray) -> Records:
+        """Pair cleaned inspections of a new batch with the latest
+        inspection of each asset in `history`, and add the records to it.
+        Inspections not later than the latest one of their asset are
+        ignored, as they have been paired already.
+        Return the new records."""
+        ids = ids.astype(str)
+        if history.states:
+            names, states = np.unique(states.astype(str),
+                                      return_inverse=True)
+            history.add_states(names)
+            smap = {s: n for n, s in enumerate(history.states)}
+            states = np.array([smap[s] for s in names], dtype=int)[states]
+        else:
+            states, _ = self._number_states(states)
+            history.add_states(self.states)
+        self.states = history.states
+
+        with profiling.stage('pair'):
+            index = np.searchsorted(history.ids, ids)
+            seen = index < len(history.ids)
+            seen[seen] = history.ids[index[seen]] == ids[seen]
+            stale = seen.copy()
+            stale[seen] = days[seen] <= history.days[index[seen]]
+            if np.any(stale):
+                print(f'{np.count_nonzero(stale)} inspections not later '
+                      'than the latest ones of their assets, ignored.',
+                      file=sys.stderr)
+            ids, states, days = ids[~stale], states[~stale], days[~stale]
+            index = np.unique(index[seen & ~stale])
+            ids = np.concatenate([history.ids[index], ids])
+            states = np.concatenate([history.last_states[index], states])
+            days = np.concatenate([history.days[index], days])
+            records = self._pair(ids, states, days)
+            history.counts += TransitionCounts.from_records(
+                len(history.states), records)
+            history.ids, history.last_states, history.days = _latest(
+                np.concatenate([history.ids, ids]),
+                np.concatenate([history.last_states, states]),
+                np.concatenate([history.days, days]))
+            profiling.record(rows=len(ids), records=len(records))
+        return records
+
+    def _clean_columns(self, ids, states, dates, *others,
+                       first_line: int = 2) -> [np.ndarray]:
+        """Apply filters, drop blank rows, and convert dates to days.
+        Return ids, states, days and then any extra column given after
+        filter columns in `others`, with the same rows.
+        `first_line` is the line number of the first row, for messages.
+        """
+        ids = np.array(ids, dtype=object)
+        states = np.array(states, dtype=object)
+        dates = np.array(dates, dtype=object)
+        filters = others[:len(self.filters)]
+        extras = [np.array(c, dtype=object)
+                  for c in others[len(self.filters):]]
+        mask = np.ones(len(ids), dtype=bool)
+        for values, column in zip(self.filters.values(), filters):
+            column = np.array(column, dtype=object).astype(str)
+            mask &= np.isin(column, values)
+        lines = np.flatnonzero(mask) + first_line
+        ids, states, dates = ids[mask], states[mask], dates[mask]
+        extras = [column[mask] for column in extras]
+
+        no_id = _blanks(ids)
+        if np.any(no_id):
+            raise ValueError(f'ID not found in row {lines[no_id][0]}')
+        blank = _blanks(states) | _blanks(dates)
+        for line, sid in zip(lines[blank], ids[blank]):
+            print(f'In row {line}, {sid} '
+                  'has blank state or time, ignored.', file=sys.stderr)
+        ids, states, dates = ids[~blank], states[~blank], dates[~blank]
+        extras = [column[~blank] for column in extras]
+        # numeric cells of .xlsx are the same as text in .csv
+        ids, states = ids.astype(str), states.astype(str)
+        return [ids, states, _dates_to_days(dates, self.time_format),
+                *extras]
+
+    def _columns_to_records(self, ids: np.ndarray, states: np.ndarray,
+                            days: np.ndarray, *segments: np.ndarray) \
+            -> (Records, int):
+        """Map states to numbers and pair inspections, of rows in
+        `_in_segment`. Return records and the total number of states."""
+        states, n_state = self._number_states(states)
+        ids, states, days = self._in_segment(segments, ids, states, days)
+        with profiling.stage('pair'):
+            records = self._pair(ids, states, days)
+            profiling.record(rows=len(ids), records=len(records))
+        return records, n_state
+
+    def _number_states(self, states: np.ndarray) -> (np.ndarray, int):
+        """Map states to numbers and keep their names in self.states.
+        Return numerical states and the total number of states."""
+        states, self.states = _number_states(states)
+        return states, len(self.states)
+
+    def _pair(self, ids: np.ndarray, states: np.ndarray,
+              days: np.ndarray) -> Records:
+        """Make records from consecutive inspections of each asset."""
+        return InspectionPairs(ids, states, days).records(self.time_unit)
+
+    def pairs_files(self, paths: [str], jobs: int = 1) \
+            -> ('InspectionPairs', int):
+        """Read consecutive inspections from files, see `read_files`.
+        Return InspectionPairs and the total number of states."""
+        ids, states, days = self.read_files(paths, jobs=jobs)
+        states, n_state = self._number_states(states)
+        with profiling.stage('pair'):
+            pairs = InspectionPairs(ids, states, days)
+            profiling.record(rows=len(ids), pairs=len(pairs.gaps))
+        return pairs, n_state
+
+
+class InspectionPairs:
+    """Consecutive inspections of each asset, from which records of any
+    time unit and binning of states are made without reading the dataset
+    again.
+
+    self.s0, self.s1: numerical states of the earlier and later
+    inspection of each pair.
+    self.gaps: days between them.
+    self.assets: number of the asset of each pair.
+    """
+    def __init__(self, ids: np.ndarray, states: np.ndarray,
+                 days: np.ndarray) -> None:
+        _, ids = np.unique(ids, return_inverse=True)
+        order = np.lexsort((states, days, ids))
+        ids, states, days = ids[order], states[order], days[order]
+        same = ids[1:] == ids[:-1]
+        self.s0 = states[:-1][same]
+        self.s1 = states[1:][same]
+        self.gaps = (days[1:] - days[:-1])[same]
+        self.assets = ids[1:][same]
+
+    def records(self, time_unit: int, bins: np.ndarray = None,
+                return_assets: bool = False) -> Records:
+        """Return records in `time_unit` days, dropping pairs less than
+        half of it apart. Map state s to `bins[s]` if given. Also return
+        the asset number of each record if `return_assets`."""
+        times = np.round(self.gaps / time_unit)
+        valid = times > 0
+        s0, s1 = self.s0[valid], self.s1[valid]
+        if bins is not None:
+            s0, s1 = bins[s0], bins[s1]
+        records = np.empty(len(s0), dtype=RECORD_DTYPE)
+        records['s0'] = s0
+        records['s1'] = s1
+        records['t'] = times[valid]
+        if return_assets:
+            return records, self.assets[valid]
+        return records
+
+
+class InspectionHistory:
+    """What is needed to update a model with new batches of inspections:
+    the latest inspection of each asset, TransitionCounts of all batches
+    so far, and the parameters of the last model.
+
+    self.fingerprint: DataSetReader.fingerprint() of the batches.
+    self.states: names of numerical states.
+    self.ids, self.last_states, self.days: the ID, numerical state and
+    day number of the latest inspection of each asset, sorted by ID.
+    """
+    def __init__(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        self.states = []
+        self.counts = TransitionCounts.from_records(0, [])
+        self.ids = np.zeros(0, dtype=str)
+        self.last_states = np.zeros(0, dtype=int)
+        self.days = np.zeros(0, dtype=int)
+        self.params = None
+
+    def add_states(self, names: [str]) -> None:
+        """Add new states `names`, and renumber the states in order."""
+        names = set(names) - set(self.states)
+        if not names:
+            return
+        smap = _map_states(set(self.states) | names)
+        mapping = np.array([smap[s] for s in self.states], dtype=int)
+        n_state = len(smap)
+        counts = np.zeros([len(self.counts.times), n_state, n_state])
+        counts[:, mapping[:, np.newaxis], mapping] = self.counts.counts
+        self.counts = TransitionCounts(self.counts.times, counts)
+        self.last_states = mapping[self.last_states]
+        self.states = sorted(smap, key=smap.get)
+        self.params = None
+
+    @staticmethod
+    def load(path: str) -> 'InspectionHistory':
+        with np.load(path) as saved:
+            history = InspectionHistory(str(saved['fingerprint']))
+            history.states = saved['states'].tolist()
+            history.counts = TransitionCounts(saved['times'],
+                                              saved['counts'])
+            history.ids = saved['ids']
+            history.last_states = saved['last_states']
+            history.days = saved['days']
+            if 'params' in saved:
+                history.params = saved['params']
+        return history
+
+    def save(self, path: str) -> None:
+        arrays = dict(fingerprint=self.fingerprint,
+                      states=np.array(self.states, dtype=str),
+                      times=self.counts.times, counts=self.counts.counts,
+                      ids=self.ids, last_states=self.last_states,
+                      days=self.days)
+        if self.params is not None:
+            arrays['params'] = self.params
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+
+class DataSetCache:
+    """Cache of parsed datasets, keyed by the hash of dataset content and
+    the reader's configuration.
+
+    Each entry is a .npz file of the TransitionCounts, and the records
+    if they were loaded, so that loading it skips parsing entirely.
+    """
+    def __init__(self, cache_dir: str, reader: DataSetReader) -> None:
+        self.cache_dir = cache_dir
+        self.reader = reader
+
+    def key(self, paths: [str]) -> str:
+        """Return the cache key of the dataset in files `paths`."""
+        digest = sha256(f'deterior {version}\n'.encode())
+        digest.update(self.reader.fingerprint().encode())
+        for path in paths:
+            digest.update(f'\n{os.path.getsize(path)}\n'.encode())
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key: str, counts_only: bool = False):
+        """Return (records, n_state) from cache, or (counts, n_state) if
+        `counts_only`. Return None if not cached."""
+        try:
+            with np.load(self._path(key)) as cached:
+                n_state = int(cached['n_state'])
+                if 'states' in cached:
+                    self.reader.states = cached['states'].tolist()
+                if counts_only:
+                    counts = TransitionCounts(cached['times'],
+                                              cached['counts'])
+                    return counts, n_state
+                if 'records' in cached:
+                    return cached['records'], n_state
+        except (OSError, ValueError, KeyError, EOFError, BadZipFile):
+            pass  # missing, truncated or corrupt, read the dataset again
+        return None
+
+    def save(self, key: str, records, n_state: int) -> None:
+        """Save records (or TransitionCounts) of a dataset to cache."""
+        if isinstance(records, TransitionCounts):
+            counts, records = records, None
+        else:
+            counts = TransitionCounts.from_records(n_state, records)
+        arrays = dict(n_state=n_state, times=counts.times,
+                      counts=counts.counts)
+        if self.reader.states is not None:
+            arrays['states'] = np.array(self.reader.states, dtype=str)
+        if records is not None:
+            arrays['records'] = records
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+
+def open_csv(path: str) -> TextIO:
+    """Open .csv, or gzip-compressed .csv.gz file for reading."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, encoding='utf-8', newline='')
+
+
+def _input_size(csvfile) -> int:
+    """Return the estimated size of CSV data in `csvfile`, either a path
+    or an open file, 0 if unknown."""
+    try:
+        if isinstance(csvfile, str):
+            size = os.path.getsize(csvfile)
+            compressed = csvfile.endswith('.gz')
+        else:
+            size = os.fstat(csvfile.fileno()).st_size
+            compressed = isinstance(getattr(csvfile, 'buffer', None),
+                                    gzip.GzipFile)
+    except (AttributeError, OSError):
+        return 0
+    return size * _GZIP_RATIO if compressed else size
+
+
+def _max_partitions() -> int:
+    """Return the number of partition files that can be open at once,
+    leaving _FD_HEADROOM for others."""
+    try:
+        import resource
+        limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ImportError, OSError, ValueError):  # e.g. on Windows
+        return _MAX_PARTITIONS
+    if limit == resource.RLIM_INFINITY:
+        return _MAX_PARTITIONS
+    return max(limit - _FD_HEADROOM, 1)
+
+
+def default_cache_dir() -> str:
+    """Return $XDG_CACHE_HOME/deterior, default to ~/.cache/deterior."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'deterior')
+
+
+def _blanks(column: np.ndarray) -> np.ndarray:
+    """Return mask of empty strings and Nones in the column.
+    Numerical zeros (e.g. state 0 in .xlsx) are not blank."""
+    return np.array([v is None or v == '' for v in column], dtype=bool)
+
+
+def _dates_to_days(dates: np.ndarray, time_format: str) -> np.ndarray:
+    """Convert a column of date strings or datetime objects to the number
+    of days since 0001-01-01.
+
+    Strings in a fixed-width format of %Y, %m and %d, like "%Y-%m-%d" and
+    "%d/%m/%Y", are parsed by vectorized arithmetic. Others (e.g. dates
+    that are not zero-padded, or other formats) are parsed by strptime,
+    once for each distinct value.
+    """
+    days = np.zeros(len(dates), dtype=int)
+    rest = np.ones(len(dates), dtype=bool)
+    layout = _date_layout(time_format)
+    if layout is not None and len(dates):
+        days, parsed = _parse_fixed_dates(dates, *layout)
+        rest = ~parsed
+    if np.any(rest):
+        memo = {}
+        for i, date in zip(np.flatnonzero(rest), dates[rest]):
+            day = memo.get(date)
+            if day is None:
+                if isinstance(date, str):
+                    day = datetime.strptime(date, time_format).toordinal()
+                else:
+                    day = date.toordinal()
+                memo[date] = day
+            days[i] = day
+    return days
+
+
+_DATE_FIELDS = {'%Y': 4, '%m': 2, '%d': 2}
+
+
+def _date_layout(time_format: str) -> (int, Dict[str, int], list):
+    """Return (width, {field: position}, [(position, character)]) of a
+    date format made of %Y, %m, %d and literal characters, or None if the
+    format has other directives."""
+    fields, literals = {}, []
+    i = width = 0
+    while i < len(time_format):
+        field = time_format[i:i + 2]
+        if field in _DATE_FIELDS and field not in fields:
+            fields[field] = width
+            width += _DATE_FIELDS[field]
+            i += 2
+        elif time_format[i] == '%':
+            return None
+        else:
+            literals.append((width, time_format[i].encode()))
+            width += 1
+            i += 1
+    if len(fields) != len(_DATE_FIELDS) or \
+            any(len(char) != 1 for _, char in literals):
+        return None
+    return width, fields, literals
+
+
+def _parse_fixed_dates(dates: np.ndarray, width: int,
+                       fields: Dict[str, int], literals: list) \
+        -> (np.ndarray, np.ndarray):
+    """Parse dates of the layout returned by `_date_layout`.
+    Return the ordinals of dates as `date.toordinal()`, and the mask of
+    dates that match the layout and are valid; other ordinals are
+    undefined."""
+    try:
+        text = dates.astype(f'S{width + 1}')
+    except UnicodeError:
+        return np.zeros(len(dates), dtype=int), \
+            np.zeros(len(dates), dtype=bool)
+    chars = text.view(np.uint8).reshape(len(dates), width + 1)
+    valid = chars[:, width] == 0  # no longer than width
+    for pos, char in literals:
+        valid &= chars[:, pos] == ord(char)
+    values = {}
+    for field, pos in fields.items():
+        size = _DATE_FIELDS[field]
+        digits = chars[:, pos:pos + size] - np.uint8(ord('0'))
+        valid &= np.all(digits <= 9, axis=1)  # non-digits wrap around
+        values[field] = digits @ 10 ** np.arange(size - 1, -1, -1)
+    year, month, day = values['%Y'], values['%m'], values['%d']
+    month_days = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30,
+                           31])[np.where(month <= 12, month, 0)]
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & \
+        (day <= month_days + (leap & (month == 2)))
+    # days from civil: count years from March, so leap days come last
+    year = year - (month <= 2)
+    era, year_of_era = np.divmod(year, 400)
+    day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) \
+        // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - \
+        year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 305, valid
+
+
+def _latest(ids: np.ndarray, states: np.ndarray, days: np.ndarray) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+    """Return ids, states and days of the latest inspection of each
+    asset, sorted by ID."""
+    _, codes = np.unique(ids, return_inverse=True)
+    order = np.lexsort((states, days, codes))
+    codes = codes[order]
+    latest = order[np.append(codes[1:] != codes[:-1], True)]
+    return ids[latest], states[latest], days[latest]
+
+
+def _number_states(states: np.ndarray) -> (np.ndarray, [str]):
+    """Map a column of states to numbers.
+    Return numerical states and names of them in order."""
+    names, states = np.unique(states, return_inverse=True)
+    smap = _map_states(set(names))
+    print(f'Found {len(smap)} states in total')
+    mapping = np.array([smap[name] for name in names], dtype=int)
+    return mapping[states], [str(s) for s in sorted(smap, key=smap.get)]
 
 
 def _map_states(states: Set[str]) -> Dict[str, int]:
@@ -132,7 +1084,7 @@ def _map_states(states: Set[str]) -> Dict[str, int]:
     return smap
 
 
-def _time_unit_to_days(time_unit: str) -> int:
+def time_unit_to_days(time_unit: str) -> int:
     """Convert "N" to N, "Nd" to N, "Nm" to N * 30, and "Ny" to N * 365.
     """
     if time_unit.isdigit():
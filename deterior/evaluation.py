@@ -3,55 +3,154 @@
 This module provides methods to validate a trained models and
 cross-validate models on given dataset.
 """
-from itertools import chain
 from collections import namedtuple
+from typing import Dict
+import os
 import sys
 import numpy as np
 
+from . import profiling
 from .models import Model
-from .dataset import Record
-from .training import prepare_validate, build_simple_model
+from .dataset import Records, TransitionCounts, as_records
+from .training import build_simple_model
 
 
-Result = namedtuple('Reulst', ['expect', 'actual', 'var', 'std', 'err'])
+Result = namedtuple('Result', ['expect', 'actual', 'var', 'std', 'err',
+                               'confusion', 'loglik', 'times', 'gap_err',
+                               'impossible'])
+Result.__new__.__defaults__ = (None,) * 5
 
-def validate_model(model: Model, records: [Record]) -> Result:
-    time_states, final_states = prepare_validate(model.n_state, records)
-    expect = model.simulate(time_states)
-    diff = final_states - expect
-    var = np.sum(diff ** 2)
+# Predicted probabilities below this are round-off of zero.
+_MIN_PROB = 1e-12
+
+
+def validate_model(model: Model, records: Records) -> Result:
+    """Compare the model with records, or their TransitionCounts, which
+    can be counted once to validate many models.
+
+    The distributions of final states are predicted for all pairs of
+    time and initial state of records at once. Return Result, where
+    expect, actual: expected and actual numbers of final states;
+    var, std, err: squared error, its square root, and the latter in
+    percentage of the number of records;
+    confusion: (n x n) array, [i, j] is the expected number of records
+    that end in state i but are predicted to be in state j;
+    loglik: log-likelihood of final states, except those of impossible;
+    times, gap_err: sorted distinct times of records, and the err of
+    records of each of the times;
+    impossible: number of records that the model gives zero probability,
+    e.g. improvements which a simple model never predicts.
+    """
+    if not isinstance(records, TransitionCounts):
+        records = TransitionCounts.from_records(model.n_state, records)
+    starts = records.counts.sum(axis=2)
+    index, initials = np.nonzero(starts)
+    predict = model.propagate(np.eye(model.n_state)[initials],
+                              records.times[index])
+    observed = records.counts[index, initials]
+    weighted = predict * starts[index, initials][:, np.newaxis]
+
+    expect = weighted.sum(axis=0)
+    actual = observed.sum(axis=0)
+    var = np.sum((actual - expect) ** 2)
     std = np.sqrt(var)
     err = std / np.sum(expect) * 100
-    np.set_printoptions(precision=2)
-    return Result(expect, final_states, var, std, err)
+
+    confusion = observed.T @ predict
+    mask = observed > 0
+    possible = predict[mask] >= _MIN_PROB
+    impossible = np.sum(observed[mask][~possible])
+    loglik = np.sum(observed[mask][possible] *
+                    np.log(predict[mask][possible]))
+
+    gap_expect = np.zeros(starts.shape)
+    np.add.at(gap_expect, index, weighted)
+    gap_diff = records.counts.sum(axis=1) - gap_expect
+    gap_err = np.sqrt(np.sum(gap_diff ** 2, axis=1)) / \
+        np.sum(gap_expect, axis=1) * 100
+    return Result(expect, actual, var, std, err,
+                  confusion, loglik, records.times, gap_err, impossible)
 
 
-def _split(l, k) -> [[Record]]:
-    """Split list `l` to `k` lists."""
+def _split(l, k) -> [np.ndarray]:
+    """Split array `l` to `k` arrays."""
     n =  int(np.ceil(len(l) / k))
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
 
-def cross_validate(n_state: int, records: [Record], k: int) -> Result:
-    np.random.shuffle(records)
-    folds = list(_split(records, k))
-    k = len(folds)
-    print('Size of each sub-sample:', len(folds[0]))
-    var, std, err = [], [], []
-    for i in range(k):
-        print(f'Test on fold {i + 1}...')
-        test = folds[i]
-        train = chain(*folds[:i], *folds[i:])
-        model, result = build_simple_model(n_state, train)
-        if model is None:
-            print(f'Fail to build model: {result.message}', file=sys.stderr)
-            return
-        result = validate_model(model, test)
-        var.append(result.var)
-        std.append(result.std)
-        err.append(result.err)
-    var = np.sum(var) / k
-    std = np.sum(std) / k
-    err = np.sum(err) / k
-    return Result(None, None, var, std, err)
+def _cross_fold(n_state: int, train: TransitionCounts,
+                test: TransitionCounts, seed: int = None):
+    """Train on `train` and validate on `test`.
+    Return (var, std, err), or error message if training failed."""
+    model, result = build_simple_model(n_state, train, seed=seed)
+    if model is None:
+        return result.message
+    result = validate_model(model, test)
+    return result.var, result.std, result.err
+
+
+def _folds(n_state: int, records: Records, k: int, seed: int = None) \
+        -> [tuple]:
+    """Shuffle records by random `seed` and split them into `k` folds.
+    Return arguments of `_cross_fold` for each fold."""
+    rand = np.random.RandomState(seed)
+    folds = list(_split(rand.permutation(len(records)), k))
+    folds = [TransitionCounts.from_records(n_state, records[fold])
+             for fold in folds]
+    tasks = []
+    for i in range(len(folds)):
+        train = TransitionCounts.from_records(n_state, [])
+        for j in range(len(folds)):
+            if j != i:
+                train += folds[j]
+        tasks.append((n_state, train, folds[i], seed))
+    return tasks
+
+
+def cross_validate(n_state: int, records: Records, k: int,
+                   jobs: int = 1, seed: int = None) -> Result:
+    """k-fold cross-validation. Folds are trained and tested on `jobs`
+    processes (all CPUs if 0), and shuffled by random `seed`."""
+    records = as_records(records)
+    print('Size of each sub-sample:', int(np.ceil(len(records) / k)))
+    return cross_validate_many({'': (n_state, records)}, k, jobs, seed)['']
+
+
+def cross_validate_many(datasets: Dict[str, tuple], k: int, jobs: int = 1,
+                        seed: int = None) -> Dict[str, Result]:
+    """k-fold cross-validation of each of {name: (n_state, records)}.
+    Folds of all datasets are trained and tested on `jobs` processes (all
+    CPUs if 0), and shuffled by random `seed`. Return {name: Result}, where
+    Result is None if any fold of the dataset failed to train."""
+    tasks = []
+    for name, (n_state, records) in datasets.items():
+        folds = _folds(n_state, as_records(records), k, seed)
+        for i, task in enumerate(folds):
+            label = f'{name}, fold {i + 1}' if name else f'fold {i + 1}'
+            tasks.append((name, label, task))
+    jobs = min(jobs or os.cpu_count(), len(tasks))
+    results = {name: [] for name in datasets}
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as executor:
+            futures = [(name, label, executor.submit(_cross_fold, *task))
+                       for name, label, task in tasks]
+            for name, label, future in futures:
+                results[name].append(future.result())
+                print(f'Tested on {label}')
+    else:
+        for name, label, task in tasks:
+            print(f'Test on {label}...')
+            with profiling.stage(label):
+                results[name].append(_cross_fold(*task))
+    means = {}
+    for name, folds in results.items():
+        failed = [r for r in folds if isinstance(r, str)]
+        if failed:
+            print(f'Fail to build model: {failed[0]}', file=sys.stderr)
+            means[name] = None
+            continue
+        var, std, err = np.mean(folds, axis=0)
+        means[name] = Result(None, None, var, std, err)
+    return means
@@ -0,0 +1,36 @@
+"""The forecasting module of deterior
+
+This module projects the state distribution of every asset in the
+inventory forward in time, given their latest inspections.
+"""
+from typing import Iterator
+import numpy as np
+
+from .models import Model
+
+
+def expected_states(model: Model, states: np.ndarray,
+                    times: np.ndarray) -> np.ndarray:
+    """Given current states of assets and the time to age each of them,
+    return the expected number of assets in each state.
+    """
+    uniques, index = np.unique(times, return_inverse=True)
+    n = model.n_state
+    counts = np.bincount(index * n + states, minlength=len(uniques) * n)
+    counts = counts.reshape(len(uniques), n)
+    return model.propagate(counts, uniques).sum(axis=0)
+
+
+def iter_asset_states(model: Model, states: np.ndarray, times: np.ndarray,
+                      chunk_size: int = 1 << 16) -> Iterator[np.ndarray]:
+    """Yield the (chunk_size x n) probabilities of states of assets,
+    chunk by chunk, in the same order as `states`.
+
+    Assets are grouped by `times`, so the power of transition matrix is
+    computed only once for each distinct time.
+    """
+    uniques, index = np.unique(times, return_inverse=True)
+    mats = model.powers(uniques)
+    for start in range(0, len(states), chunk_size):
+        end = start + chunk_size
+        yield mats[index[start:end], states[start:end]]
@@ -5,11 +5,14 @@ implemented save/load operation, and simulation used by training
 and life curves. But the actual training process is done by the
 `training` module.
 """
+import io
 import json
+import mmap
+import struct
 from csv import DictWriter
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from datetime import datetime
-from typing import Dict, TextIO
+from typing import Dict, TextIO, BinaryIO
 import numpy as np
 
 from . import __version__ as version
@@ -17,86 +20,462 @@ from . import __version__ as version
 
 TimeStates =  Dict[int, np.ndarray]
 
+# Eigenvectors worse conditioned than this are considered numerically
+# defective, and the model falls back to binary powering.
+_MAX_EIGVEC_COND = 1e6
+
+# Matrices with at least this many states and at most this density are
+# kept in sparse form, and simulated step by step. scipy.sparse is only
+# imported for them, as it's slow to import.
+SPARSE_MIN_STATES = 32
+SPARSE_MAX_DENSITY = 0.1
+
+# Models keep at most this many powers of their matrix, so that memory
+# doesn't grow with every new time asked, e.g. by a long-running server.
+POWER_CACHE_SIZE = 128
+
+# Binary model files start with the magic and a little-endian uint64
+# offset of data, followed by a JSON header padded to that offset, and
+# raw arrays aligned to _BINARY_ALIGN bytes so they can be mapped as is.
+BINARY_MAGIC = b'DETERIOR'
+_BINARY_ALIGN = 64
+
+
+class _PowerCache:
+    """Memoized binary powering of a square matrix.
+
+    Squares M^(2^k) are kept once computed, as well as requested powers,
+    so each distinct time costs at most log2(time) matrix products. Only
+    the `max_powers` most recently used powers are kept if given.
+    """
+    def __init__(self, mat: np.ndarray, max_powers: int = None) -> None:
+        self._squares = [mat]
+        self._powers = OrderedDict([(0, np.eye(mat.shape[0])), (1, mat)])
+        self.max_powers = max_powers
+
+    def power(self, time: int) -> np.ndarray:
+        """Return M^time."""
+        time = int(time)
+        mat = self._powers.get(time)
+        if mat is not None:
+            self._powers.move_to_end(time)
+            return mat
+        if time < 0:
+            raise ValueError('time must be non-negative')
+        mat = None
+        bit, rest = 0, time
+        while rest:
+            if bit == len(self._squares):
+                self._squares.append(self._squares[-1] @ self._squares[-1])
+            if rest & 1:
+                square = self._squares[bit]
+                mat = square if mat is None else mat @ square
+            rest >>= 1
+            bit += 1
+        if mat is None:
+            mat = np.eye(self._squares[0].shape[0])
+        self._powers[time] = mat
+        if self.max_powers is not None and \
+                len(self._powers) > self.max_powers:
+            self._powers.popitem(last=False)
+        return mat
+
+    def powers(self, times: np.ndarray) -> np.ndarray:
+        """Return M^t for each t in `times` as a (len(times), n, n) array.
+        """
+        if not len(times):
+            return np.zeros((0,) + self._squares[0].shape)
+        return np.stack([self.power(t) for t in times])
+
+
 class Model:
     """The generic Markov chain model.
 
-    self.mat: transition/probability matrix, the core of model.
+    self.mat: transition/probability matrix, the core of model. Either
+        a dense np.matrix, or a scipy.sparse.csr_matrix for large and
+        sparse (e.g. banded) matrices.
     self.n_state: the total number of states.
+    self.sparse: whether self.mat is sparse.
+    self.time_unit: days of one time step, if known.
+    self.states: names of states in the dataset, if known.
+    self.group_by: the column of the dataset, if the model is built on
+        the rows of one value of it, which is its name in the bundle.
     """
-    def __init__(self, prob_matrix: np.matrix) -> None:
-        """Build a model by given probability matrix.
+    def __init__(self, prob_matrix, use_sparse: bool = None) -> None:
+        """Build a model by given probability matrix, either dense or
+        sparse. Sparse form is used if `use_sparse`, or automatically by
+        the size and density of matrix if it's None.
         """
-        self.mat = prob_matrix
         self.n_state = prob_matrix.shape[0]
         if prob_matrix.shape != (self.n_state, self.n_state):
             raise ValueError('shape of probability matrix must be (n x n)')
-        for i in range(self.n_state):
-            if not 0.999999 < np.sum(self.mat[i]) < 1.000001:
-                raise ValueError(f'sum of row {i} in probability matrix != 1')
+        is_dense = isinstance(prob_matrix, np.ndarray)
+        if use_sparse is None:
+            nnz = np.count_nonzero(prob_matrix) if is_dense \
+                else prob_matrix.nnz
+            use_sparse = self.n_state >= SPARSE_MIN_STATES and \
+                nnz <= SPARSE_MAX_DENSITY * self.n_state ** 2
+        if use_sparse:
+            from scipy import sparse
+            self.mat = sparse.csr_matrix(prob_matrix)
+            if not np.all(self.mat.data):
+                # Copy first, the matrix may share a read-only buffer.
+                self.mat = self.mat.copy()
+                self.mat.eliminate_zeros()
+        elif not is_dense:
+            self.mat = np.asmatrix(prob_matrix.toarray())
+        else:
+            self.mat = np.asmatrix(prob_matrix)
+        self.sparse = bool(use_sparse)
+        sums = np.asarray(self.mat.sum(axis=1)).reshape(-1)
+        for i in np.flatnonzero((sums <= 0.999999) | (sums >= 1.000001)):
+            raise ValueError(f'sum of row {i} in probability matrix != 1')
+        self.time_unit = None
+        self.states = None
+        self.group_by = None
+        self._eig = None
+        self._cache = None
+
+    def dense(self) -> np.ndarray:
+        """Return the transition matrix as a dense ndarray."""
+        if self.sparse:
+            return self.mat.toarray()
+        return np.asarray(self.mat)
+
+    def _eigendecompose(self) -> (np.ndarray, np.ndarray):
+        """Return eigenvalues and right eigenvectors (as columns).
+        Sparse models are not decomposed, as the vectors are dense."""
+        if self.sparse:
+            return None
+        return np.linalg.eig(np.asarray(self.mat))
+
+    def eigen(self):
+        """Return (eigvals, V, V^-1) so that mat = V diag(eigvals) V^-1,
+        or None if the matrix is not (numerically) diagonalizable.
+        """
+        if self._eig is None:
+            self._eig = False
+            decomposition = self._eigendecompose()
+            if decomposition is not None:
+                eigvals, vecs = decomposition
+                try:
+                    inv = np.linalg.inv(vecs)
+                except np.linalg.LinAlgError:
+                    inv = None
+                if inv is not None and np.all(np.isfinite(inv)):
+                    cond = np.linalg.norm(vecs, 1) * np.linalg.norm(inv, 1)
+                    if cond < _MAX_EIGVEC_COND:
+                        self._eig = (eigvals, vecs, inv)
+        return self._eig or None
+
+    def power(self, time: int) -> np.ndarray:
+        """Return mat^time as an ndarray. Results are memoized."""
+        if self._cache is None:
+            self._cache = _PowerCache(self.dense(), POWER_CACHE_SIZE)
+        return self._cache.power(time)
+
+    def powers(self, times: np.ndarray) -> np.ndarray:
+        """Return (len(times) x n x n) array of mat^t for each t in times.
+        """
+        times = np.asarray(times, dtype=int).reshape(-1)
+        eig = self.eigen()
+        if eig is not None:
+            eigvals, vecs, inv = eig
+            scale = eigvals[np.newaxis, :] ** times[:, np.newaxis]
+            return np.real((vecs[np.newaxis] * scale[:, np.newaxis]) @ inv)
+        if self._cache is None:
+            self._cache = _PowerCache(self.dense(), POWER_CACHE_SIZE)
+        return self._cache.powers(times)
+
+    def propagate(self, states: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """Given (k x n) initial state vectors and k times, return the
+        (k x n) state vectors after each of the times.
+        """
+        states = np.asarray(states, dtype=float).reshape(-1, self.n_state)
+        times = np.asarray(times, dtype=int).reshape(-1)
+        eig = self.eigen()
+        if eig is not None:
+            eigvals, vecs, inv = eig
+            scale = eigvals[np.newaxis, :] ** times[:, np.newaxis]
+            return np.real((states @ vecs) * scale @ inv)
+        if self.sparse:
+            return self._propagate_steps(states, times)
+        uniques, index = np.unique(times, return_inverse=True)
+        mats = self.powers(uniques)
+        return np.einsum('ki,kij->kj', states, mats[index])
+
+    def _propagate_steps(self, states: np.ndarray, times: np.ndarray) \
+            -> np.ndarray:
+        """`propagate` by multiplying sparse matrix step by step. Each step
+        costs O(nnz) for each state vector not yet reached its time."""
+        order = np.argsort(times, kind='stable')
+        ends = times[order]
+        vectors = states[order].T.copy()  # one column for each vector
+        mat_t = self.mat.T.tocsr()
+        for step in range(ends[-1] if len(ends) else 0):
+            start = np.searchsorted(ends, step, side='right')
+            vectors[:, start:] = mat_t @ vectors[:, start:]
+        result = np.empty_like(states)
+        result[order] = vectors.T
+        return result
 
     def simulate(self, time_states: TimeStates) -> np.ndarray:
         """Given times and initial state vectors, return expectation of final
         states.
         """
-        exp = np.mat(np.zeros(self.n_state))
-        for time, states in time_states.items():
-            exp += states * self.mat ** time
-        return np.array(exp)[0]
+        if not time_states:
+            return np.zeros(self.n_state)
+        times = np.fromiter(time_states.keys(), dtype=int)
+        states = np.array(list(time_states.values()), dtype=float)
+        return self.propagate(states, times).sum(axis=0)
 
     def simulate_curve(self,
                        init_state: int,
                        start: int, stop: int, step: int) -> np.ndarray:
         """Used to generate life curve. Given initial state, start time,
         stop time, and time step, return estimated probabilities."""
-        mat = self.mat ** start
-        init = np.zeros(self.n_state)
-        init[init_state] = 1
-        rows = len(range(start, stop, step))
-        exps = np.zeros([rows, self.n_state])
-        for i in range(rows):
-            exps[i] = init * mat
-            mat *= self.mat ** step
-        return exps
+        return self.simulate_curves([init_state], start, stop, step)[0]
 
+    def simulate_curves(self, init_states: [int],
+                        start: int, stop: int, step: int) -> np.ndarray:
+        """Batched `simulate_curve`. Return a (len(init_states) x times x
+        n_state) array, where times are range(start, stop, step).
+        All initial states are simulated if `init_states` is None.
+        """
+        if init_states is None:
+            init_states = range(self.n_state)
+        init_states = np.asarray(init_states, dtype=int)
+        times = np.arange(start, stop, step)
+        eig = self.eigen()
+        if eig is not None:
+            eigvals, vecs, inv = eig
+            scale = eigvals[np.newaxis, :] ** times[:, np.newaxis]
+            curves = (vecs[init_states][:, np.newaxis, :] * scale) @ inv
+            # clear round-off errors around 0 and 1
+            return np.clip(np.real(curves), 0, 1)
+        curves = np.zeros([len(init_states), len(times), self.n_state])
+        if not len(times):
+            return curves
+        if self.sparse:
+            vectors = np.zeros([self.n_state, len(init_states)])
+            vectors[init_states, np.arange(len(init_states))] = 1
+            mat_t = self.mat.T.tocsr()
+            for i in range(len(times)):
+                for _ in range(start if i == 0 else step):
+                    vectors = mat_t @ vectors
+                curves[:, i] = vectors.T
+            return curves
+        mat = self.power(start)[init_states]
+        step_mat = self.power(step)
+        for i in range(len(times)):
+            curves[:, i] = mat
+            mat = mat @ step_mat
+        return curves
 
     def to_csv(self, csvfile: TextIO) -> None:
         """Write internal transition matrix to CSV file"""
         fieldnames = ['Init State'] + [f'S{i}' for i in range(self.n_state)]
         csv = DictWriter(csvfile, fieldnames)
         csv.writeheader()
+        mat = self.dense()
         for i in range(self.n_state):
             row = {'Init State': f'S{i}'}
             for j in range(self.n_state):
-                row[f'S{j}'] = self.mat[i, j]
+                row[f'S{j}'] = mat[i, j]
             csv.writerow(row)
 
 
-    def dump(self, fp: TextIO) -> None:
-        """Dump the model into file-like object `fp`"""
+    def _meta(self) -> dict:
+        """Return the type, size and metadata of the model."""
+        meta = {'type': f'{type(self).__name__}', 'n_state': self.n_state}
+        if self.time_unit is not None:
+            meta['time_unit'] = self.time_unit
+        if self.states is not None:
+            meta['states'] = list(self.states)
+        if self.group_by is not None:
+            meta['group_by'] = self.group_by
+        return meta
+
+    def _set_meta(self, meta: dict) -> None:
+        """Set metadata from `meta` returned by `_meta`."""
+        self.time_unit = meta.get('time_unit')
+        self.states = meta.get('states')
+        self.group_by = meta.get('group_by')
+
+    def _to_obj(self) -> dict:
+        """Return the model as a JSON-serializable object."""
         mat = defaultdict(dict)
-        for i in range(self.n_state):
-            for j in range(self.n_state):
-                if self.mat[i, j] > 0:
-                    mat[i][j] = self.mat[i, j]
+        if self.sparse:
+            coo = self.mat.tocoo()
+            rows, cols, probs = coo.row, coo.col, coo.data
+        else:
+            rows, cols = np.nonzero(self.mat)
+            probs = np.asarray(self.mat)[rows, cols]
+        for i, j, p in sorted(zip(rows.tolist(), cols.tolist(),
+                                  probs.tolist())):
+            if p > 0:
+                mat[i][j] = p
+        return {**self._meta(), 'transition_matrix': mat}
+
+    @staticmethod
+    def _from_obj(obj: dict):
+        """Build the model from object returned by `_to_obj`."""
+        n = obj['n_state']
+        rows, cols, probs = [], [], []
+        for i, row in obj['transition_matrix'].items():
+            rows.extend([int(i)] * len(row))
+            cols.extend(int(j) for j in row.keys())
+            probs.extend(row.values())
+        if n >= SPARSE_MIN_STATES:
+            from scipy import sparse
+            mat = sparse.coo_matrix((probs, (rows, cols)), shape=(n, n))
+        else:
+            mat = np.zeros((n, n))
+            mat[rows, cols] = probs
+        model = Model(mat)
+        model._set_meta(obj)
+        return model
+
+    def _to_arrays(self) -> Dict[str, np.ndarray]:
+        """Return arrays of the model for the binary format."""
+        if self.sparse:
+            return {'data': self.mat.data, 'indices': self.mat.indices,
+                    'indptr': self.mat.indptr}
+        return {'matrix': self.dense()}
+
+    @staticmethod
+    def _from_arrays(meta: dict, arrays: Dict[str, np.ndarray]):
+        """Build the model from metadata and arrays returned by `_meta` and
+        `_to_arrays`. Arrays are used as is, without copying."""
+        n = meta['n_state']
+        if meta['type'] == 'SimpleModel' and 'probs' in arrays:
+            model = SimpleModel(arrays['probs'])
+        elif 'matrix' in arrays:
+            model = Model(arrays['matrix'], use_sparse=False)
+        else:
+            from scipy import sparse
+            mat = sparse.csr_matrix(
+                (arrays['data'], arrays['indices'], arrays['indptr']),
+                shape=(n, n), copy=False)
+            model = Model(mat, use_sparse=True)
+        model._set_meta(meta)
+        return model
+
+    def dump(self, fp, binary: bool = False) -> None:
+        """Dump the model into file-like object `fp`, as JSON text, or in
+        binary format into a binary file if `binary`."""
+        if binary:
+            _dump_binary({'': self}, 'Model', fp)
+            return
         obj = {
             '_note': f'Model dumped by Deterior v{version}',
             '_saved_at': datetime.now().isoformat(),
-            'type': f'{type(self).__name__}',
-            'n_state': self.n_state,
-            'transition_matrix': mat,
+            **self._to_obj(),
         }
         json.dump(obj, fp, indent=2)
 
     @staticmethod
-    def load(fp: TextIO):
-        """Load the model from file-like object `fp`"""
+    def load(fp):
+        """Load the model from file-like object `fp`, either JSON or binary
+        format. Binary files are memory-mapped if possible."""
+        kind, models = _read_models(fp)
+        if kind == 'ModelBundle':
+            raise ValueError('it is a bundle of models, use load_bundle()')
+        return models['']
+
+
+def dump_bundle(models: Dict[str, Model], fp, binary: bool = False) -> None:
+    """Dump named models into file-like object `fp` as a single bundle,
+    as JSON text, or in binary format into a binary file if `binary`."""
+    if binary:
+        _dump_binary(models, 'ModelBundle', fp)
+        return
+    obj = {
+        '_note': f'Models dumped by Deterior v{version}',
+        '_saved_at': datetime.now().isoformat(),
+        'type': 'ModelBundle',
+        'models': {name: model._to_obj() for name, model in models.items()},
+    }
+    json.dump(obj, fp, indent=2)
+
+
+def load_bundle(fp) -> Dict[str, Model]:
+    """Load named models from file-like object `fp`, either JSON or binary
+    format. A single model file is loaded as a bundle with one model
+    named ""."""
+    return _read_models(fp)[1]
+
+
+def _read_models(fp) -> (str, Dict[str, Model]):
+    """Read models from JSON or binary file `fp`.
+    Return the type of file ("Model" or "ModelBundle") and named models.
+    """
+    if isinstance(fp, io.TextIOBase):
         obj = json.load(fp)
-        n = obj['n_state']
-        mat = np.mat(np.zeros([n, n]))
-        for i, cols in obj['transition_matrix'].items():
-            for j, p in cols.items():
-                mat[int(i), int(j)] = p
-        return Model(mat)
+    else:
+        head = fp.read(len(BINARY_MAGIC))
+        if head == BINARY_MAGIC:
+            return _read_binary(fp, head)
+        obj = json.loads((head + fp.read()).decode('utf-8'))
+    if obj.get('type') != 'ModelBundle':
+        return 'Model', {'': Model._from_obj(obj)}
+    return 'ModelBundle', {name: Model._from_obj(model)
+                           for name, model in obj['models'].items()}
+
+
+def _read_binary(fp: BinaryIO, head: bytes) -> (str, Dict[str, Model]):
+    """Read models from binary file `fp`, of which `head` has been read.
+    Arrays of models are mapped from the file, or share one buffer if it
+    cannot be mapped (e.g. a pipe)."""
+    try:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        buf = head + fp.read()
+    start, = struct.unpack_from('<Q', buf, len(BINARY_MAGIC))
+    obj = json.loads(bytes(buf[len(BINARY_MAGIC) + 8:start]).decode('utf-8'))
+    models = {}
+    for name, meta in obj['models'].items():
+        arrays = {}
+        for key, (offset, dtype, shape) in meta['arrays'].items():
+            count = int(np.prod(shape, dtype=int))
+            arrays[key] = np.frombuffer(buf, dtype, count, start + offset) \
+                .reshape(shape)
+        models[name] = Model._from_arrays(meta, arrays)
+    return obj['type'], models
+
+
+def _dump_binary(models: Dict[str, Model], kind: str, fp: BinaryIO) \
+        -> None:
+    """Write models into binary file `fp`. See BINARY_MAGIC."""
+    metas, arrays = {}, []
+    offset = 0
+    for name, model in models.items():
+        meta = model._meta()
+        meta['arrays'] = {}
+        for key, array in model._to_arrays().items():
+            array = np.ascontiguousarray(array)
+            offset += -offset % _BINARY_ALIGN
+            meta['arrays'][key] = [offset, array.dtype.str, array.shape]
+            arrays.append((offset, array))
+            offset += array.nbytes
+        metas[name] = meta
+    header = json.dumps({
+        '_note': f'Models dumped by Deterior v{version}',
+        '_saved_at': datetime.now().isoformat(),
+        'version': version,
+        'type': kind,
+        'models': metas,
+    }).encode('utf-8')
+    start = len(BINARY_MAGIC) + 8 + len(header)
+    start += -start % _BINARY_ALIGN
+    fp.write(BINARY_MAGIC)
+    fp.write(struct.pack('<Q', start))
+    fp.write(header.ljust(start - len(BINARY_MAGIC) - 8))
+    position = 0
+    for offset, array in arrays:
+        fp.write(bytes(offset - position))
+        fp.write(array.data)
+        position = offset + array.nbytes
 
 
 class SimpleModel(Model):
@@ -115,6 +494,7 @@ class SimpleModel(Model):
         if not all(0 <= p <= 1.000001 for p in probs):
             raise ValueError('each p in probs must between 0 and 1')
 
+        self.probs = np.asarray(probs, dtype=float)
         n = len(probs) + 1
         mat = np.mat(np.zeros([n, n]))
         mat[n-1, n-1] = 1
@@ -122,3 +502,28 @@ class SimpleModel(Model):
             mat[i, i] = 1 - probs[i]
             mat[i, i+1] = probs[i]
         super().__init__(mat)
+
+    def _to_arrays(self) -> Dict[str, np.ndarray]:
+        """Also keep parameters, so it loads back as a SimpleModel."""
+        return {**super()._to_arrays(), 'probs': self.probs}
+
+    def _eigendecompose(self) -> (np.ndarray, np.ndarray):
+        """Closed-form eigen decomposition of the upper bidiagonal matrix.
+
+        Eigenvalues are the diagonal 1 - p_k. Eigenvector k has zeros
+        below row k, one on row k, and v_j = v_{j+1} p_j / (p_j - p_k)
+        above it. Return None if two equal non-zero p make it defective.
+        """
+        probs = np.append(self.probs, 0)
+        n = len(probs)
+        diff = probs[:, np.newaxis] - probs[np.newaxis, :]
+        upper = np.triu(np.ones([n, n], dtype=bool), 1)
+        if np.any(upper & (diff == 0) & (probs[:, np.newaxis] != 0)):
+            return None
+        ratio = np.ones([n, n])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio[upper] = (probs[:, np.newaxis] / diff)[upper]
+        ratio[~np.isfinite(ratio)] = 0  # both p are zero
+        vecs = np.flip(np.cumprod(np.flip(ratio, 0), 0), 0)
+        vecs[np.tril(np.ones([n, n], dtype=bool), -1)] = 0
+        return 1 - probs, vecs
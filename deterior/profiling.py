@@ -0,0 +1,117 @@
+"""The profiling module of deterior
+
+This module collects the wall time and metrics (e.g. the number of rows
+or loss evaluations) of nested stages of the pipeline, and optionally
+profiles each top-level stage with cProfile.
+
+Other modules mark stages with `stage()` or `staged()`, and report
+metrics of the current stage with `record()`. They do nothing unless
+`enable()` has been called, so they can be left in the code.
+"""
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import cProfile
+import os
+
+_profiler = None
+
+
+class Profiler:
+    """Collect wall time and metrics of nested stages.
+
+    Stages that record `rows` or `evaluations` also get the rate of rows
+    per second or seconds per evaluation.
+    """
+    def __init__(self, cprofile_dir: str = None) -> None:
+        self.cprofile_dir = cprofile_dir
+        self.stages = []
+        self._stack = [{'stages': self.stages}]
+        self._start = perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        record = {'name': name, 'seconds': None, 'stages': []}
+        self._stack[-1]['stages'].append(record)
+        self._stack.append(record)
+        profile = None
+        if self.cprofile_dir and len(self._stack) == 2:
+            profile = cProfile.Profile()
+            profile.enable()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            record['seconds'] = seconds
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.cprofile_dir, exist_ok=True)
+                filename = f'{len(self.stages):02d}-{name}.prof'
+                path = os.path.join(self.cprofile_dir,
+                                    filename.replace(' ', '-'))
+                profile.dump_stats(path)
+                record['cprofile'] = path
+            if 'rows' in record and seconds > 0:
+                record['rows_per_second'] = record['rows'] / seconds
+            if record.get('evaluations'):
+                record['seconds_per_evaluation'] = \
+                    seconds / record['evaluations']
+            stages = record.pop('stages')
+            if stages:
+                record['stages'] = stages
+            self._stack.pop()
+
+    def record(self, **metrics) -> None:
+        """Set metrics of the current stage."""
+        self._stack[-1].update(metrics)
+
+    def to_obj(self) -> dict:
+        """Return the JSON-serializable metrics of all stages."""
+        return {'seconds': perf_counter() - self._start,
+                'stages': self.stages}
+
+
+class _NoStage:
+    """Context manager doing nothing, used when profiling is disabled."""
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+
+_NO_STAGE = _NoStage()
+
+
+def enable(cprofile_dir: str = None) -> Profiler:
+    """Start collecting metrics, and dump cProfile stats of top-level
+    stages into `cprofile_dir` if given. Return the profiler."""
+    global _profiler
+    _profiler = Profiler(cprofile_dir)
+    return _profiler
+
+
+def stage(name: str):
+    """Return context manager that measures the stage `name`."""
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name)
+
+
+def staged(name: str):
+    """Decorator that measures each call of the function as stage `name`.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(**metrics) -> None:
+    """Set metrics of the current stage, if profiling is enabled."""
+    if _profiler is not None:
+        _profiler.record(**metrics)
@@ -0,0 +1,263 @@
+"""The server module of deterior
+
+This module serves queries on models over HTTP, on a TCP port or a Unix
+socket, so that models are loaded and decomposed once rather than on
+every invocation of the command line tools.
+
+All requests and responses are JSON. Endpoints:
+
+  POST /simulate  {"model": "name.bin", "segment": "NAME",
+                   "states": [s, ...] or "distributions": [[p, ...], ...],
+                   "times": [t, ...] or t}
+      -> {"probs": [[p, ...], ...]}, state probabilities of each query.
+  POST /curves    {"model": ..., "segment": ..., "states": [s, ...],
+                   "start": t0, "stop": t1, "step": s}
+      -> {"times": [t, ...], "curves": [[[p, ...], ...], ...]}, life
+         curves of given initial states, or all states if omitted.
+  GET  /models    -> {"models": {"name.bin": ["NAME", ...], ...}}, models
+                     currently in the cache.
+
+Models are named by their paths relative to the served directory.
+"""
+import asyncio
+import json
+import os
+import sys
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Dict
+import numpy as np
+
+from .models import Model, load_bundle
+
+# Largest time accepted in queries. Sparse models step through every
+# time, and dense ones need log2(time) products for each distinct time.
+MAX_TIME = 1000_000
+
+
+class RequestError(Exception):
+    """Error caused by the request, answered with `status`."""
+    def __init__(self, message: str,
+                 status: HTTPStatus = HTTPStatus.BAD_REQUEST) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ModelCache:
+    """LRU cache of model bundles loaded from files under `root`.
+
+    Eigen decompositions (or the squares for binary powering) are kept
+    with the models, so repeated queries skip them. A file is reloaded
+    if it has been modified since it was cached.
+    """
+    def __init__(self, root: str, size: int = 16) -> None:
+        self.root = os.path.realpath(root)
+        self.size = size
+        self._bundles = OrderedDict()
+
+    def path(self, name: str) -> str:
+        """Return the path of model `name`, which must be under root."""
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise RequestError(f'model "{name}" is out of served directory',
+                               HTTPStatus.FORBIDDEN)
+        return path
+
+    def get(self, name: str, segment: str = None) -> Model:
+        """Return the model, or the one named `segment` in a bundle."""
+        models = self.bundle(name)
+        if segment is None and list(models) == ['']:
+            return models['']
+        if segment not in models:
+            names = ', '.join(f'"{seg}"' for seg in models)
+            raise RequestError(f'segment of model "{name}" must be one of '
+                               f'{names}', HTTPStatus.NOT_FOUND)
+        return models[segment]
+
+    def bundle(self, name: str) -> Dict[str, Model]:
+        """Return named models in file `name`, load it if not cached."""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise RequestError(f'model "{name}" not found',
+                               HTTPStatus.NOT_FOUND)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._bundles.get(name)
+        if cached is not None and cached[0] == version:
+            self._bundles.move_to_end(name)
+            return cached[1]
+        try:
+            with open(path, 'rb') as f:
+                models = load_bundle(f)
+        except (OSError, ValueError, KeyError) as err:
+            raise RequestError(f'cannot load model "{name}": {err}')
+        for model in models.values():
+            if not model.sparse:
+                model.eigen()
+        self._bundles[name] = version, models
+        self._bundles.move_to_end(name)
+        while len(self._bundles) > self.size:
+            self._bundles.popitem(last=False)
+        return models
+
+    def names(self) -> Dict[str, list]:
+        """Return names of cached files and their models."""
+        return {name: list(models)
+                for name, (_, models) in self._bundles.items()}
+
+
+def _times(value, name: str = 'times') -> np.ndarray:
+    """Return `value` of a query as an array of times, which must be
+    integers in 0 to MAX_TIME."""
+    times = np.asarray(value)
+    if not times.size:
+        return times.astype(int)
+    if times.dtype.kind not in 'iu' or \
+            np.any((times < 0) | (times > MAX_TIME)):
+        kind = 'integers' if times.ndim else 'an integer'
+        raise RequestError(f'{name} must be {kind} in 0 to {MAX_TIME}')
+    return times.astype(int)
+
+
+def _time(value, name: str) -> int:
+    """Return `value` of a query as a single time, see `_times`."""
+    if np.ndim(value):
+        raise RequestError(f'{name} must be an integer')
+    return int(_times(value, name))
+
+
+def simulate(model: Model, query: dict) -> dict:
+    """Answer a /simulate query."""
+    times = _times(query.get('times', 0))
+    if 'distributions' in query:
+        dists = np.asarray(query['distributions'], dtype=float)
+        if dists.ndim != 2 or dists.shape[1] != model.n_state:
+            raise RequestError(f'distributions must be of {model.n_state} '
+                               'states')
+        times = np.broadcast_to(times, dists.shape[:1])
+        probs = model.propagate(dists, times)
+        return {'probs': np.clip(probs, 0, 1).tolist()}
+    states = np.asarray(query.get('states', []), dtype=int).reshape(-1)
+    if np.any((states < 0) | (states >= model.n_state)):
+        raise RequestError(f'states must be in 0 to {model.n_state - 1}')
+    times = np.broadcast_to(times, states.shape)
+    uniques, index = np.unique(times, return_inverse=True)
+    probs = model.powers(uniques)[index, states]
+    return {'probs': np.clip(probs, 0, 1).tolist()}
+
+
+def curves(model: Model, query: dict) -> dict:
+    """Answer a /curves query."""
+    start = _time(query.get('start', 0), 'start')
+    stop = _time(query['stop'], 'stop')
+    step = _time(query.get('step', 1), 'step')
+    if step <= 0:
+        raise RequestError('step must be positive')
+    states = query.get('states')
+    if states is not None:
+        states = [int(s) for s in states]
+        if any(s < 0 or s >= model.n_state for s in states):
+            raise RequestError(
+                f'states must be in 0 to {model.n_state - 1}')
+    result = model.simulate_curves(states, start, stop, step)
+    return {'times': list(range(start, stop, step)),
+            'curves': result.tolist()}
+
+
+class Server:
+    """HTTP/1.1 server of queries on models, with keep-alive."""
+    def __init__(self, cache: ModelCache) -> None:
+        self.cache = cache
+
+    def dispatch(self, method: str, target: str, body: bytes) -> dict:
+        """Return the response object of a request."""
+        path = target.split('?', 1)[0]
+        if method == 'GET' and path == '/models':
+            return {'models': self.cache.names()}
+        handler = {'/simulate': simulate, '/curves': curves}.get(path)
+        if handler is None:
+            raise RequestError(f'{path} not found', HTTPStatus.NOT_FOUND)
+        if method != 'POST':
+            raise RequestError(f'use POST for {path}',
+                               HTTPStatus.METHOD_NOT_ALLOWED)
+        try:
+            query = json.loads(body.decode('utf-8'))
+            model = self.cache.get(query['model'], query.get('segment'))
+            return handler(model, query)
+        except np.linalg.LinAlgError as err:
+            raise RequestError(f'cannot compute: {err}',
+                               HTTPStatus.INTERNAL_SERVER_ERROR)
+        except MemoryError:
+            raise RequestError('out of memory, query is too large',
+                               HTTPStatus.INTERNAL_SERVER_ERROR)
+        except (KeyError, TypeError, ValueError, OverflowError) as err:
+            if isinstance(err, KeyError):
+                err = f'{err} is required'
+            raise RequestError(f'bad query: {err}')
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Serve requests on one connection until it's closed."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length)
+                try:
+                    status = HTTPStatus.OK
+                    obj = self.dispatch(method, target, body)
+                except RequestError as err:
+                    status, obj = err.status, {'error': str(err)}
+                data = json.dumps(obj).encode('utf-8')
+                writer.write(
+                    f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                    'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(data)}\r\n\r\n'
+                    .encode('latin-1') + data)
+                await writer.drain()
+                if version == 'HTTP/1.0' or \
+                        headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass  # malformed request or client gone
+        finally:
+            writer.close()
+
+
+def serve(root: str, host: str = '127.0.0.1', port: int = 8080,
+          unix: str = None, cache_size: int = 16) -> None:
+    """Serve models under directory `root` on host:port, or on the Unix
+    socket `unix` if given, until interrupted."""
+    server = Server(ModelCache(root, cache_size))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if unix:
+        start = asyncio.start_unix_server(server.handle, unix)
+        where = unix
+    else:
+        start = asyncio.start_server(server.handle, host, port)
+        where = f'http://{host}:{port}'
+    listener = loop.run_until_complete(start)
+    print(f'Serving models in {server.cache.root} on {where}',
+          file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        loop.run_until_complete(listener.wait_closed())
+        loop.close()
+        if unix:
+            os.unlink(unix)
@@ -5,87 +5,549 @@ Each task contains a sequance of I/O operations and computations.
 
 This module contains all the tasks.
 It's the actual entry of deterior.
+
+Modules that are slow to import, or only used by some of the tasks, are
+imported inside the tasks that use them, to keep the startup fast.
 """
 from io import TextIOWrapper
 from argparse import Namespace
+from functools import partial
+from csv import writer as csv_writer
+from datetime import datetime
+from glob import glob
+from typing import Dict, BinaryIO
+import json
+import os
 import sys
-import matplotlib.pyplot as plt
+import numpy as np
 
-from .models import Model
-from .dataset import DataSetReader, Record
-from .training import build_simple_model
-from .evaluation import validate_model, cross_validate
+from . import profiling
+from .models import Model, dump_bundle, load_bundle
+from .dataset import DataSetReader, DataSetCache, InspectionHistory, \
+    InspectionPairs, Records, TransitionCounts, default_cache_dir, \
+    time_unit_to_days
 
 
-def _get_records(args) -> ([Record], int):
-    reader = DataSetReader(args.format)
-    if args.dataset.name.endswith('.csv'):
-        csvfile = TextIOWrapper(args.dataset, 'utf-8')
-        records, n_state = reader.load_csv(csvfile)
-    elif args.dataset.name.endswith('.xlsx'):
-        records, n_state = reader.load_xls(args.dataset)
+def _dataset_paths(args) -> [str]:
+    """Expand globs in `args.dataset`, and check the type of files."""
+    paths = []
+    for pattern in args.dataset:
+        is_glob = any(c in pattern for c in '*?[')
+        matches = sorted(glob(pattern)) if is_glob else [pattern]
+        if not matches:
+            print(f'No file matches {pattern}.', file=sys.stderr)
+            sys.exit(1)
+        paths.extend(matches)
+    for path in paths:
+        if not path.endswith(('.csv', '.csv.gz', '.xlsx')):
+            print(f'Unknown file type: {path}, please rename its suffix to '
+                  'either .csv, .csv.gz or .xlsx.', file=sys.stderr)
+            sys.exit(1)
+        if not os.path.isfile(path):
+            print(f'File {path} not found.', file=sys.stderr)
+            sys.exit(1)
+    return paths
+
+
+@profiling.staged('load dataset')
+def _get_records(args, reader: DataSetReader, counts_only: bool = False) \
+        -> (Records, int):
+    """Load records of the dataset, from cache if possible.
+    Return TransitionCounts instead of records if `counts_only`."""
+    paths = _dataset_paths(args)
+    stream = getattr(args, 'stream', False)
+    cache = key = None
+    if not args.no_cache:
+        cache = DataSetCache(args.cache_dir or default_cache_dir(), reader)
+        key = cache.key(paths)
+    if key is not None:
+        cached = cache.load(key, counts_only or stream)
+        if cached is not None:
+            records, n_state = cached
+            print(f'{len(records)} inspection records loaded from cache')
+            profiling.record(cache=True, records=len(records))
+            return records, n_state
+
+    if stream:
+        if any(path.endswith('.xlsx') for path in paths):
+            print('Streaming mode supports .csv files only.',
+                  file=sys.stderr)
+            sys.exit(1)
+        records, n_state = reader.stream_csv(paths, args.partitions)
     else:
-        print(f'Unknown file type: {args.dataset.name}, '
-              'please rename its suffix to either .csv or .xlsx.',
-              file=sys.stderr)
-        sys.exit(1)
+        records, n_state = reader.load_files(paths, args.read_jobs)
     print(f'{len(records)} inspection records loaded')
+    profiling.record(cache=False, records=len(records))
+    if key is not None:
+        cache.save(key, records, n_state)
+    if counts_only and not isinstance(records, TransitionCounts):
+        records = TransitionCounts.from_records(n_state, records)
     return records, n_state
 
 
+@profiling.staged('load dataset')
+def _get_latest(args, reader: DataSetReader) \
+        -> ((np.ndarray, np.ndarray, np.ndarray), int):
+    """Load the latest inspection of each asset in the dataset.
+    Return ((ids, states, days), n_state)."""
+    latest, n_state = reader.latest_files(_dataset_paths(args),
+                                          args.read_jobs)
+    print(f'{len(latest[0])} assets loaded')
+    return latest, n_state
+
+
+@profiling.staged('load dataset')
+def _get_groups(args, reader: DataSetReader) -> (Dict[str, Records], int):
+    """Load records of the dataset grouped by `args.group_by`."""
+    groups, n_state = reader.load_files_groups(
+        _dataset_paths(args), args.group_by, args.read_jobs)
+    print(f'{sum(len(r) for r in groups.values())} inspection records '
+          f'loaded in {len(groups)} groups')
+    return groups, n_state
+
+
+@profiling.staged('load dataset')
+def _get_pairs(args, reader: DataSetReader) -> (InspectionPairs, int):
+    """Load consecutive inspections of each asset in the dataset."""
+    pairs, n_state = reader.pairs_files(_dataset_paths(args),
+                                        args.read_jobs)
+    print(f'{len(pairs.gaps)} pairs of inspections loaded')
+    return pairs, n_state
+
+
+@profiling.staged('load dataset')
+def _get_batch(args, reader: DataSetReader, history: InspectionHistory) \
+        -> Records:
+    """Add the batch of inspections in the dataset to `history`.
+    Return the new records."""
+    records = reader.update_files(_dataset_paths(args), history,
+                                  args.read_jobs)
+    print(f'{len(records)} new inspection records, '
+          f'{len(history.counts)} in total')
+    return records
+
+
+def _load_history(path: str, reader: DataSetReader) -> InspectionHistory:
+    """Load the history at `path`, or a new one if it doesn't exist."""
+    if not os.path.exists(path):
+        print(f'Creating new history {path}')
+        return InspectionHistory(reader.fingerprint())
+    history = InspectionHistory.load(path)
+    if history.fingerprint != reader.fingerprint():
+        print(f'History {path} was made with other dataset format.',
+              file=sys.stderr)
+        sys.exit(1)
+    return history
+
+
+@profiling.staged('load model')
+def _load_model(args) -> Model:
+    """Load the model, or the one named by `args.segment` in a bundle."""
+    models = load_bundle(args.model)
+    segment = getattr(args, 'segment', None)
+    if segment is None and list(models) == ['']:
+        return models['']
+    if segment not in models:
+        names = ', '.join(f'"{name}"' for name in models)
+        print(f'Use --segment to choose one of models: {names}',
+              file=sys.stderr)
+        sys.exit(1)
+    return models[segment]
+
+
+def _filter_segment(model: Model, reader: DataSetReader, args) -> None:
+    """Read only rows of the segment of the model, if it is chosen by
+    --segment from a bundle built with --group-by."""
+    segment = getattr(args, 'segment', None)
+    if segment is None or model.group_by is None:
+        return
+    if getattr(args, 'stream', False):
+        print('--stream cannot read rows of a segment only, filter them '
+              'in the dataset format instead.', file=sys.stderr)
+        sys.exit(1)
+    reader.segment = (model.group_by, segment)
+    print(f'Use rows of {model.group_by} "{segment}" only')
+
+
+def _check_meta(model: Model, reader: DataSetReader) -> None:
+    """Warn if the model was built on other time unit or states."""
+    if model.time_unit is not None and model.time_unit != reader.time_unit:
+        print(f'Warning: time unit of the model is {model.time_unit} days, '
+              f'but {reader.time_unit} days in the dataset format.',
+              file=sys.stderr)
+    if model.states is not None and reader.states is not None and \
+            model.states != reader.states:
+        print(f'Warning: states of the model {model.states} differ from '
+              f'states of the dataset {reader.states}.', file=sys.stderr)
+
+
+@profiling.staged('save model')
+def _save(models: Dict[str, Model], args: Namespace) -> None:
+    """Save the model, or the bundle of models if `args.group_by`, in
+    `args.output_type` format."""
+    group_by = getattr(args, 'group_by', None)
+    if args.output_type == 'bin':
+        if group_by:
+            dump_bundle(models, args.model, binary=True)
+        else:
+            models[''].dump(args.model, binary=True)
+        return
+    textfile = TextIOWrapper(args.model, 'utf-8', newline='')
+    if group_by:
+        dump_bundle(models, textfile)
+    elif args.output_type == 'json':
+        models[''].dump(textfile)
+    else:
+        models[''].to_csv(textfile)
+    textfile.flush()
+    textfile.detach()
+
+
+def _trainer(args: Namespace):
+    """Return the picklable function to train the model of `args.model`.
+    """
+    from .training import build_simple_model, build_general_model
+    options = {} if args.tol is None else {'tol': args.tol}
+    if args.model_type == 'general':
+        return partial(build_general_model,
+                       max_deteriorate=args.max_deteriorate,
+                       max_improve=args.max_improve, **options)
+    # processes train groups in parallel, or search the only model
+    workers = 1 if args.group_by else args.jobs
+    return partial(build_simple_model, starts=args.starts, workers=workers,
+                   seed=args.seed, **options)
+
+
 def build(args: Namespace) -> None:
     """Build task. Tranining model with records and save the model.
     """
-    records, n_state = _get_records(args)
+    if args.bootstrap and (args.group_by or args.stream or
+                           args.model_type != 'simple'):
+        print('--bootstrap works with simple model without --group-by or '
+              '--stream only.', file=sys.stderr)
+        sys.exit(1)
+    if args.group_by:
+        _build_groups(args)
+        return
+    reader = DataSetReader(args.format)
+    if args.bootstrap:
+        # assets of records are needed to resample them
+        pairs, n_state = _get_pairs(args, reader)
+        records, assets = pairs.records(reader.time_unit,
+                                        return_assets=True)
+    else:
+        records, n_state = _get_records(args, reader, counts_only=True)
     print('Training...')
-    model, result = build_simple_model(n_state, records)
+    with profiling.stage('train'):
+        model, result = _trainer(args)(n_state, records)
     if model:
         print('Done')
         print(f'  Iterations: {result.nit}')
         print(f'        Loss: {result.fun}')
         print(f'  Parameters: {result.x}')
-        if args.output_type == 'json':
-            model.dump(args.model)
-        elif args.output_type == 'csv':
-            model.to_csv(args.model)
+        model.time_unit, model.states = reader.time_unit, reader.states
+        _save({'': model}, args)
         print(f'Model saved as {args.model.name}')
+        if args.bootstrap:
+            _bootstrap(model, records, assets, args)
     else:
         print('Failed:', result.message)
         print(result)
 
 
+def _bootstrap(model: Model, records: Records, assets: np.ndarray,
+               args: Namespace) -> None:
+    """Bootstrap the model by resampling `assets` of records, print
+    percentile bands of parameters, and save them with bands of life
+    curves next to the model."""
+    from .models import SimpleModel
+    from .training import bootstrap_simple_model
+    print(f'Bootstrapping {args.bootstrap} replicates...')
+    params = bootstrap_simple_model(model.n_state, records, assets,
+                                    model.probs, args.bootstrap, args.jobs,
+                                    args.seed)
+    failed = np.isnan(params).any(axis=1)
+    if np.any(failed):
+        print(f'{np.count_nonzero(failed)} replicates failed to fit, '
+              'ignored.', file=sys.stderr)
+    params = params[~failed]
+    if not len(params):
+        return
+    percents = [(100 - args.level) / 2, (100 + args.level) / 2]
+    lower, upper = np.percentile(params, percents, axis=0)
+    print(f'  {args.level:g}% intervals of parameters:')
+    for i, (p, lo, hi) in enumerate(zip(model.probs, lower, upper)):
+        print(f'    S{i} -> S{i + 1}: {p:.4g} [{lo:.4g}, {hi:.4g}]')
+
+    with profiling.stage('bootstrap curves'):
+        stop = args.curve_to + 1
+        curves = np.stack([SimpleModel(p).simulate_curves(None, 0, stop, 1)
+                           for p in params])
+        curve_lower, curve_upper = np.percentile(curves, percents, axis=0)
+    bands = {
+        'replicates': len(params),
+        'level': args.level,
+        'params': {
+            'estimate': model.probs.tolist(),
+            'lower': lower.tolist(),
+            'upper': upper.tolist(),
+        },
+        # [initial state][time][state], time from 0 to curve_to
+        'curves': {
+            'estimate': model.simulate_curves(None, 0, stop, 1).tolist(),
+            'lower': curve_lower.tolist(),
+            'upper': curve_upper.tolist(),
+        },
+    }
+    path = os.path.splitext(args.model.name)[0] + '.bands.json'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(bands, f)
+    print(f'Bands of parameters and life curves saved as {path}')
+
+
+def _build_groups(args: Namespace) -> None:
+    """Build one model for each group of records and save as a bundle."""
+    from .training import build_models
+    if args.output_type == 'csv' or args.stream:
+        print('--group-by works with json or bin output without --stream '
+              'only.', file=sys.stderr)
+        sys.exit(1)
+    reader = DataSetReader(args.format)
+    groups, n_state = _get_groups(args, reader)
+    print(f'Training {len(groups)} models...')
+    with profiling.stage('train'):
+        results = build_models(n_state, groups, args.jobs, _trainer(args))
+    models = {}
+    for name, (model, result) in results.items():
+        if model:
+            model.time_unit, model.states = reader.time_unit, reader.states
+            model.group_by = args.group_by
+            models[name] = model
+            print(f'  "{name}": {len(groups[name])} records, '
+                  f'loss {result.fun:.3g}, parameters {result.x}')
+        else:
+            print(f'  "{name}": failed, {result.message}')
+    _save(models, args)
+    print(f'{len(models)} models saved as {args.model.name}')
+
+
+def update(args: Namespace) -> None:
+    """Update task. Add a new batch of inspections to the history, and
+    train the model again, starting from the last one.
+    """
+    from .training import build_simple_model
+    reader = DataSetReader(args.format)
+    history = _load_history(args.history, reader)
+    _get_batch(args, reader, history)
+    print('Training...')
+    with profiling.stage('train'):
+        model, result = build_simple_model(
+            len(history.states), history.counts, starts=args.starts,
+            workers=args.jobs, seed=args.seed, init=history.params)
+    if not model:
+        print('Failed:', result.message)
+        print(result)
+        # keep the batch, so that its inspections pair with the next one
+        history.save(args.history)
+        print(f'History of {len(history.ids)} assets saved as '
+              f'{args.history}')
+        sys.exit(1)
+    print('Done')
+    print(f'  Iterations: {result.nit}')
+    print(f'        Loss: {result.fun}')
+    print(f'  Parameters: {result.x}')
+    model.time_unit, model.states = reader.time_unit, history.states
+    _save({'': model}, args)
+    print(f'Model saved as {args.model.name}')
+    history.params = result.x
+    history.save(args.history)
+    print(f'History of {len(history.ids)} assets saved as {args.history}')
+
+
 def cross(args: Namespace) -> None:
     """Corss task. Corss validate model on given dataset."""
-    records, n_state = _get_records(args)
-    result = cross_validate(n_state, records, args.k)
+    from .evaluation import cross_validate
+    records, n_state = _get_records(args, DataSetReader(args.format))
+    with profiling.stage('cross validate'):
+        result = cross_validate(n_state, records, args.k, args.jobs,
+                                args.seed)
     print(f"Mean Variance: {result.var:.3f}")
     print(f"Mean StdDev:   {result.std:.3f}")
     print(f"Mean Error:    {result.err:.3f}%")
 
 
+def _parse_bins(scheme: str, states: [str]) -> np.ndarray:
+    """Parse binning of states like "0+1,2,3+4", where states joined by
+    "+" are merged, and bins are numbered in order. Return the bin of
+    each numerical state."""
+    bins = np.full(len(states), -1)
+    for i, names in enumerate(scheme.split(',')):
+        for name in names.split('+'):
+            name = name.strip()
+            if name not in states:
+                print(f'Unknown state "{name}" in --bins {scheme}, states '
+                      f'are {", ".join(states)}.', file=sys.stderr)
+                sys.exit(1)
+            if bins[states.index(name)] >= 0:
+                print(f'State "{name}" is in more than one bin of --bins '
+                      f'{scheme}.', file=sys.stderr)
+                sys.exit(1)
+            bins[states.index(name)] = i
+    if np.any(bins < 0):
+        missing = [s for s, b in zip(states, bins) if b < 0]
+        print(f'States {", ".join(missing)} are not in any bin of --bins '
+              f'{scheme}.', file=sys.stderr)
+        sys.exit(1)
+    return bins
+
+
+def sweep(args: Namespace) -> None:
+    """Sweep task. Cross-validate the simple model with each combination of
+    time units and binnings of states, and rank them by error.
+    """
+    from .evaluation import cross_validate_many
+    reader = DataSetReader(args.format)
+    try:
+        units = [time_unit_to_days(unit.strip())
+                 for unit in args.units.split(',')] if args.units \
+            else [reader.time_unit]
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    pairs, n_state = _get_pairs(args, reader)
+    schemes = {'none': None}
+    for scheme in args.bins or []:
+        schemes[scheme] = _parse_bins(scheme, reader.states)
+
+    variants, datasets = {}, {}
+    for unit in units:
+        for scheme, bins in schemes.items():
+            name = f'unit {unit}d, bins {scheme}'
+            records = pairs.records(unit, bins)
+            n = n_state if bins is None else int(bins.max()) + 1
+            variants[name] = (unit, scheme, n, len(records))
+            datasets[name] = (n, records)
+    print(f'Cross-validating {len(datasets)} variants...')
+    with profiling.stage('cross validate'):
+        results = cross_validate_many(datasets, args.k, args.jobs,
+                                      args.seed)
+
+    ranked = sorted(variants, key=lambda name: (
+        results[name] is None, results[name] and results[name].err))
+    print(f'{"Rank":>4} {"Unit":>6}  {"Bins":<20} {"States":>6} '
+          f'{"Records":>8} {"StdDev":>9} {"Error":>8}')
+    for rank, name in enumerate(ranked, 1):
+        unit, scheme, n, size = variants[name]
+        result = results[name]
+        scores = f'{result.std:9.3f} {result.err:7.3f}%' if result \
+            else f'{"failed":>18}'
+        print(f'{rank:>4} {unit:>5}d  {scheme:<20} {n:>6} {size:>8} '
+              f'{scores}')
+
+
 def validate(args: Namespace) -> None:
     """Validate task. Compare output of given model and dataset.
     """
+    from .evaluation import validate_model
     # TODO: handle load error
-    records, n_state = _get_records(args)
-    model = Model.load(args.model)
+    reader = DataSetReader(args.format)
+    model = _load_model(args)
+    _filter_segment(model, reader, args)
+    records, n_state = _get_records(args, reader, counts_only=True)
     if n_state != model.n_state:
         print(f'Cannot verify {model.n_state}-state model on {n_state}-state '
               'dataset.', file=sys.stderr)
         sys.exit(1)
-    result = validate_model(model, records)
-    print(f"Exception: {result.expect}")
-    print(f"Actual:    {result.actual}")
+    _check_meta(model, reader)
+    with profiling.stage('validate'):
+        result = validate_model(model, records)
+    print(f"Exception: {np.array2string(result.expect, precision=2)}")
+    print(f"Actual:    {np.array2string(result.actual, precision=2)}")
     print(f"Variance:  {result.var:.3f}")
     print(f"StdDev:    {result.std:.3f}")
     print(f"Error:     {result.err:.3f}%")
+    print(f"Log-likelihood: {result.loglik:.3f}")
+    if result.impossible:
+        print(f"  excluding {result.impossible:.0f} records of zero "
+              "probability")
+    print('Confusion (actual in rows, predicted in columns):')
+    names = [f'S{i}' for i in range(n_state)]
+    print('      ' + ''.join(f'{name:>10}' for name in names))
+    for name, row in zip(names, result.confusion):
+        print(f'  {name:<4}' + ''.join(f'{n:10.1f}' for n in row))
+    if not args.per_gap:
+        return
+    print('Error of each time:')
+    sizes = records.counts.sum(axis=(1, 2))
+    for time, size, err in zip(result.times, sizes, result.gap_err):
+        print(f'  {time:>6}: {err:7.3f}% of {size:.0f} records')
+
+
+def forecast(args: Namespace) -> None:
+    """Forecast task. Age every asset from its latest inspection to a
+    common horizon, and estimate the number of assets in each state.
+    """
+    from .forecasting import expected_states
+    model = _load_model(args)
+    reader = DataSetReader(args.format)
+    _filter_segment(model, reader, args)
+    (ids, states, days), n_state = _get_latest(args, reader)
+    if n_state != model.n_state:
+        print(f'Cannot forecast {n_state}-state dataset with '
+              f'{model.n_state}-state model.', file=sys.stderr)
+        sys.exit(1)
+    _check_meta(model, reader)
+    time_unit = model.time_unit or reader.time_unit
+    if args.at:
+        now = datetime.strptime(args.at, '%Y-%m-%d').toordinal()
+    elif len(days):
+        now = int(days.max())
+    else:
+        now = 0
+    times = np.maximum(np.round((now - days) / time_unit), 0).astype(int)
+    times += args.horizon
+    date = datetime.fromordinal(now).date()
+    print(f'Forecasting {args.horizon} time units after {date}...')
+
+    with profiling.stage('forecast'):
+        expect = expected_states(model, states, times)
+    for i, n in enumerate(expect):
+        print(f'  S{i}: {n:.1f}')
+    if args.output:
+        _save_forecast(model, ids, states, times, args.output)
+
+
+@profiling.staged('save forecast')
+def _save_forecast(model: Model, ids: np.ndarray, states: np.ndarray,
+                   times: np.ndarray, output: BinaryIO) -> None:
+    """Save state probabilities of each asset as CSV file."""
+    from .forecasting import iter_asset_states
+    csvfile = TextIOWrapper(output, 'utf-8', newline='')
+    csv = csv_writer(csvfile)
+    csv.writerow(['ID', 'State', 'Time'] +
+                 [f'S{i}' for i in range(model.n_state)])
+    start = 0
+    for probs in iter_asset_states(model, states, times):
+        end = start + len(probs)
+        csv.writerows([sid, f'S{s}', t] + p for sid, s, t, p in zip(
+            ids[start:end], states[start:end].tolist(),
+            times[start:end].tolist(), probs.tolist()))
+        start = end
+    csvfile.flush()
+    csvfile.detach()
+    print(f'Forecast of each asset saved as {output.name}')
 
 
 def lifecurve(args: Namespace) -> None:
-    """Lifecurve task. Plot the life curve for given model.
+    """Lifecurve task. Plot the life curve for given model, or export
+    curves of all initial states.
     """
-    model = Model.load(args.model)
+    model = _load_model(args)
     print('Model loaded, waiting...')
+    if args.export:
+        _export_curves(model, args)
+        return
+    import matplotlib.pyplot as plt
     curve = model.simulate_curve(
         args.state, args.start, args.stop, args.step
     )
@@ -102,3 +564,34 @@ def lifecurve(args: Namespace) -> None:
         print(f'Figure saved as {args.output.name}')
     else:
         plt.show()
+
+
+@profiling.staged('export curves')
+def _export_curves(model: Model, args: Namespace) -> None:
+    """Save life curves of all initial states as .npy or .csv file."""
+    curves = model.simulate_curves(None, args.start, args.stop, args.step)
+    if args.export.name.endswith('.npy'):
+        np.save(args.export, curves)
+    else:
+        csvfile = TextIOWrapper(args.export, 'utf-8', newline='')
+        csv = csv_writer(csvfile)
+        csv.writerow(['Init State', 'Time'] +
+                     [f'S{i}' for i in range(model.n_state)])
+        times = range(args.start, args.stop, args.step)
+        for init, curve in enumerate(curves):
+            for time, probs in zip(times, curve.tolist()):
+                csv.writerow([f'S{init}', time] + probs)
+        csvfile.flush()
+        csvfile.detach()
+    print(f'Curves of {model.n_state} initial states saved as '
+          f'{args.export.name}')
+
+
+def serve(args: Namespace) -> None:
+    """Serve task. Answer queries on models in a directory over HTTP."""
+    from .server import serve as serve_models
+    if not os.path.isdir(args.directory):
+        print(f'{args.directory} is not a directory.', file=sys.stderr)
+        sys.exit(1)
+    serve_models(args.directory, args.host, args.port, args.unix,
+                 args.cache_size)
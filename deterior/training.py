@@ -4,44 +4,396 @@ This module provides methods to train the modules, and helper methods
 to prepare data using in training.
 """
 import sys
-from collections import defaultdict
-from scipy import optimize
+from typing import Dict
+import os
 import numpy as np
 
-from .models import SimpleModel, TimeStates
-from .dataset import Record
+from . import profiling
+from .models import Model, SimpleModel, TimeStates, _PowerCache
+from .dataset import Records, TransitionCounts, as_records
 
 
-def prepare_validate(n_state: int, records: [Record]) \
+def prepare_validate(n_state: int, records: Records) \
         -> (TimeStates, np.ndarray):
-    """Convert records to (time_states, final_states)."""
-    time_states = defaultdict(lambda: np.zeros([n_state]))
-    final_states = np.zeros([n_state])
-    for s0, s1, t in records:
-        time_states[t][s0] += 1
-        final_states[s1] += 1
-    return time_states, final_states
+    """Convert records or TransitionCounts to (time_states, final_states).
+    """
+    if not isinstance(records, TransitionCounts):
+        records = TransitionCounts.from_records(n_state, records)
+    return records.time_states(), records.final_states()
+
+
+def _power_kernel(eigvals: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Return the (k x n x n) divided differences of x^t over eigenvalues.
+
+    Element [t, a, b] is sum(l_a^j * l_b^(t-1-j) for j < t), that is
+    (l_a^t - l_b^t) / (l_a - l_b), or t * l_a^(t-1) when l_a == l_b.
+    In eigenbasis, it maps the derivative of a matrix to the derivative
+    of the matrix to the power of t.
+    """
+    times = times[:, np.newaxis, np.newaxis]
+    la = eigvals[np.newaxis, :, np.newaxis]
+    lb = eigvals[np.newaxis, np.newaxis, :]
+    diff = la - lb
+    close = np.abs(diff) < 1e-12
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quotient = (la ** times - lb ** times) / np.where(close, 1, diff)
+        derivative = times * la ** np.maximum(times - 1, 0)
+    return np.where(close, derivative, quotient)
+
+
+def _power_sum(squares: _PowerCache, weight: np.ndarray, gap: int) \
+        -> (np.ndarray, np.ndarray):
+    """Return (sum(M^k W M^(gap-1-k) for k < gap), M^gap) by doubling,
+    where `squares` memoizes the squares of M. It takes O(log(gap))
+    matrix products."""
+    total = power = None
+    bit = 0
+    while True:
+        square = squares.power(1 << bit)
+        if gap & 1:
+            if total is None:
+                total, power = weight, square
+            else:
+                total = power @ weight + total @ square
+                power = power @ square
+        gap >>= 1
+        if not gap:
+            return total, power
+        weight = square @ weight + weight @ square
+        bit += 1
+
+
+def _power_derivative(mat: np.ndarray, times: np.ndarray,
+                      weights: np.ndarray) -> np.ndarray:
+    """Return sum(M^k W_t M^(t-1-k) for k < t) over `times` and their
+    (n x n) `weights` W_t, that is the derivative of sum(M^t) in the
+    directions of W_t, whether or not M is diagonalizable.
+
+    It walks down the sorted times, carrying the weights of larger times
+    along, so each gap between two times costs O(log(gap)) products.
+    """
+    squares = _PowerCache(mat)
+    times = np.asarray(times, dtype=int)
+    order = np.argsort(times, kind='stable')[::-1]
+    lows = np.append(times[order][1:], 0)
+    carry = np.zeros(mat.shape)
+    total = np.zeros(mat.shape)
+    for i, time, low in zip(order, times[order], lows):
+        carry = carry + weights[i]
+        if time > low:
+            inner, power = _power_sum(squares, carry, int(time - low))
+            total = inner + power @ total
+            if low > 0:
+                carry = carry @ power
+    return total
+
+
+class _SimpleLoss:
+    """Squared error between expected and actual final states of
+    SimpleModel, as a function of its transition probabilities.
+    """
+    def __init__(self, time_states: TimeStates, final_states: np.ndarray):
+        self.times = np.fromiter(time_states.keys(), dtype=int)
+        self.states = np.array(list(time_states.values()), dtype=float) \
+            .reshape(-1, len(final_states))
+        self.final_states = final_states
+
+    def __call__(self, param) -> float:
+        model = SimpleModel(param)
+        expect = model.propagate(self.states, self.times).sum(axis=0)
+        diff = self.final_states - expect
+        return np.sum(diff ** 2)
+
+    def with_grad(self, param) -> (float, np.ndarray):
+        """Return the loss and its exact gradient."""
+        model = SimpleModel(param)
+        expect = model.propagate(self.states, self.times).sum(axis=0)
+        diff = self.final_states - expect
+        eig = model.eigen()
+        if eig is not None:
+            grad = self._grad_eigen(eig, diff)
+        else:
+            grad = self._grad_block(model, diff)
+        return np.sum(diff ** 2), -2 * grad
+
+    def _grad_eigen(self, eig, diff: np.ndarray) -> np.ndarray:
+        """d(expect)/dp . diff, in the eigenbasis of the model.
+
+        dM/dp_i moves probability from (i, i) to (i, i+1), so in
+        eigenbasis it is the outer product of inv[:, i] and
+        vecs[i+1] - vecs[i].
+        """
+        eigvals, vecs, inv = eig
+        kernel = _power_kernel(eigvals, self.times)
+        weight = np.einsum('ta,tab,b->ab',
+                           self.states @ vecs, kernel, inv @ diff)
+        steps = vecs[1:] - vecs[:-1]
+        return np.real(np.einsum('ai,ab,ib->i', inv[:, :-1], weight, steps))
+
+    def _grad_block(self, model: SimpleModel, diff: np.ndarray) \
+            -> np.ndarray:
+        """d(expect)/dp . diff for defective matrices.
+
+        d(s M^t d) = sum(s M^k dM M^(t-1-k) d), so the gradient over M is
+        the transposed power derivative of M in directions d s.
+        """
+        weights = diff[np.newaxis, :, np.newaxis] * \
+            self.states[:, np.newaxis, :]
+        grad = _power_derivative(model.dense(), self.times, weights).T
+        index = np.arange(model.n_state - 1)
+        return grad[index, index + 1] - grad[index, index]
+
+
+def _local_minimize(loss: _SimpleLoss, init: np.ndarray, tol: float):
+    """Minimize `loss` from `init` by L-BFGS-B with the exact gradient."""
+    from scipy import optimize
+    options = {} if tol is None else {'ftol': tol}
+    return optimize.minimize(loss.with_grad, init, jac=True,
+                             bounds=[(0, 1)] * len(init), options=options)
+
+
+def _multi_start(loss: _SimpleLoss, local, starts: int, workers: int,
+                 tol: float, seed: int):
+    """Run local searches from `starts` random points on `workers`
+    processes (all CPUs if 0). Return the best result including `local`,
+    where `nfev` counts the evaluations of all searches."""
+    rand = np.random.RandomState(seed)
+    inits = rand.uniform(size=(starts, len(local.x)))
+    workers = min(workers or os.cpu_count(), max(starts, 1))
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(
+                _local_minimize, [loss] * starts, inits, [tol] * starts,
+                chunksize=-(-starts // workers)))
+    else:
+        results = [_local_minimize(loss, init, tol) for init in inits]
+    results = [r for r in results if r.success] or results
+    best = min(results + [local], key=lambda r: r.fun)
+    best.nfev = local.nfev + sum(r.nfev for r in results)
+    return best
 
 
-def build_simple_model(n_state: int, records: [Record]):
+def _no_records(init: np.ndarray):
+    """Return the failed result of training on no records."""
+    from scipy.optimize import OptimizeResult
+    return OptimizeResult(x=init, fun=np.nan, nit=0, nfev=0, success=False,
+                          message='no records')
+
+
+def build_simple_model(n_state: int, records: Records, starts: int = 20,
+                       workers: int = 1, tol: float = None,
+                       seed: int = None, init: np.ndarray = None):
     """Train the SimpleModel using inspection records.
     Return trained model and the result returned from optimiser.
+
+    The local optimiser starts from parameters `init` if given, e.g. of
+    the model trained on part of the records.
+
+    If the local optimiser ends with a large loss, search again from
+    `starts` random points, on `workers` processes (all CPUs if 0).
+    `tol` is the relative tolerance of loss, and random `seed` makes
+    the result reproducible.
     """
     time_states, final_states = prepare_validate(n_state, records)
-    def loss(param):
-        model = SimpleModel(param)
-        expect = model.simulate(time_states)
-        diff = final_states - expect
-        return np.sum(diff ** 2)
+    loss = _SimpleLoss(time_states, final_states)
 
-    n_params = n_state - 1
-    init = np.array([0.1] * n_params)
-    bounds = [(0, 1)] * n_params
-    result = optimize.minimize(loss, init, bounds=bounds)
-    if result.fun > 1:
+    if init is None or len(init) != n_state - 1:
+        init = np.array([0.1] * (n_state - 1))
+    if not final_states.sum():
+        return None, _no_records(init)
+    with profiling.stage('minimize'):
+        result = _local_minimize(loss, init, tol)
+        profiling.record(evaluations=result.nfev, iterations=result.nit,
+                         loss=float(result.fun))
+    if result.fun > 1 and starts > 0:
         print(f'Loss {result.fun} too large, '
-              'use differential evolution', file=sys.stderr)
-        result = optimize.differential_evolution(loss, bounds)
+              f'search from {starts} random points', file=sys.stderr)
+        with profiling.stage('multi-start'):
+            result = _multi_start(loss, result, starts, workers, tol, seed)
+            profiling.record(evaluations=result.nfev, starts=starts,
+                             loss=float(result.fun))
     if not result.success:
         return None, result
     return SimpleModel(result.x), result
+
+
+def _bootstrap_fits(n_state: int, records: Records, assets: np.ndarray,
+                    init: np.ndarray, seeds: [int]) -> np.ndarray:
+    """Refit SimpleModel on replicates of `records` of `assets` (numbered
+    from 0) drawn with `seeds`, starting from `init`. Return parameters
+    of each replicate, NaN if the fit failed."""
+    n_asset = assets.max() + 1 if len(assets) else 0
+    params = np.full((len(seeds), n_state - 1), np.nan)
+    for i, seed in enumerate(seeds):
+        rand = np.random.RandomState(seed)
+        draws = np.bincount(rand.randint(n_asset, size=n_asset),
+                            minlength=n_asset)
+        sample = TransitionCounts.from_records(n_state, records,
+                                               draws[assets])
+        model, _ = build_simple_model(n_state, sample, starts=0, init=init)
+        if model is not None:
+            params[i] = model.probs
+    return params
+
+
+def bootstrap_simple_model(n_state: int, records: Records,
+                           assets: np.ndarray, init: np.ndarray,
+                           replicates: int, jobs: int = 1,
+                           seed: int = None) -> np.ndarray:
+    """Bootstrap the parameters of SimpleModel.
+
+    Each replicate draws as many assets as there are with replacement,
+    and takes all records of each asset drawn, as records of the same
+    asset are correlated. `assets` identifies the asset of each record.
+    Replicates are refitted from the parameters `init` of the model
+    fitted on all records. They run on `jobs` processes (all CPUs if 0),
+    and are reproducible with the random `seed` whatever the number of
+    processes. Return (replicates x n_state - 1) parameters, NaN for
+    failed fits.
+    """
+    records = as_records(records)
+    _, assets = np.unique(assets, return_inverse=True)
+    seeds = np.random.RandomState(seed).randint(1 << 31, size=replicates)
+    jobs = min(jobs or os.cpu_count(), max(replicates, 1))
+    if jobs <= 1:
+        with profiling.stage('bootstrap'):
+            params = _bootstrap_fits(n_state, records, assets, init, seeds)
+            profiling.record(replicates=replicates)
+        return params
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(_bootstrap_fits, n_state, records,
+                                   assets, init, chunk)
+                   for chunk in np.array_split(seeds, jobs)]
+        return np.concatenate([future.result() for future in futures])
+
+
+def _band_mask(n_state: int, max_deteriorate: int, max_improve: int) \
+        -> np.ndarray:
+    """Return mask of transitions that change state from i to j, where
+    i - max_improve <= j <= i + max_deteriorate."""
+    steps = np.arange(n_state)[np.newaxis, :] - \
+        np.arange(n_state)[:, np.newaxis]
+    return (steps <= max_deteriorate) & (steps >= -max_improve)
+
+
+def _expected_transitions(model: Model, counts: TransitionCounts) \
+        -> (np.ndarray, float):
+    """E-step of EM. Return the expected number of single-step
+    transitions (n x n) behind the observed counts, and the
+    log-likelihood of counts.
+
+    For an observation from s0 to s1 after t steps, the expected
+    number of i -> j steps is sum((M^k)[s0, i] M[i, j] (M^(t-1-k))[j, s1]
+    for k < t) / (M^t)[s0, s1].
+    """
+    mat = model.dense()
+    powers = model.powers(counts.times)
+    observed = counts.counts > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(observed, counts.counts / powers, 0)
+        loglik = np.sum(counts.counts[observed] * np.log(powers[observed]))
+    ratio[~np.isfinite(ratio)] = 0  # observed but impossible
+    eig = model.eigen()
+    if eig is not None:
+        # sum(M^T^k R M^T^(t-1-k)) = W^T (kernel * (V^T R W^T)) V^T
+        eigvals, vecs, inv = eig
+        kernel = _power_kernel(eigvals, counts.times)
+        inner = np.sum(kernel * (vecs.T @ ratio @ inv.T), axis=0)
+        weight = np.real(inv.T @ inner @ vecs.T)
+    else:
+        # sum(M^T^k R M^T^(t-1-k)), transposed to powers of M
+        weight = _power_derivative(
+            mat, counts.times, ratio.transpose(0, 2, 1)).T
+    return np.maximum(mat * weight, 0), loglik
+
+
+def build_general_model(n_state: int, records: Records,
+                        max_deteriorate: int = 1, max_improve: int = 0,
+                        max_iter: int = 1000, tol: float = 1e-8):
+    """Train a generic Model by expectation-maximization.
+
+    The transition matrix is banded: each step may deteriorate up to
+    `max_deteriorate` states, and improve up to `max_improve` states.
+    Return trained model and an OptimizeResult, where `fun` is the
+    negative log-likelihood and `x` are the entries within the band.
+    """
+    from scipy.optimize import OptimizeResult
+    if not isinstance(records, TransitionCounts):
+        records = TransitionCounts.from_records(n_state, records)
+    mask = _band_mask(n_state, max_deteriorate, max_improve)
+    off_diagonal = mask & ~np.eye(n_state, dtype=bool)
+    n_off = off_diagonal.sum(axis=1, keepdims=True)
+    # distinct eigenvalues keep the initial model diagonalizable
+    stay = np.where(n_off[:, 0] > 0, np.linspace(0.88, 0.92, n_state), 1)
+    mat = np.where(off_diagonal,
+                   (1 - stay[:, np.newaxis]) / np.maximum(n_off, 1), 0)
+    mat[np.diag_indices(n_state)] = stay
+    if not len(records):
+        return None, _no_records(mat[mask])
+
+    def em_step(mat):
+        expect, loglik = _expected_transitions(
+            Model(mat, use_sparse=False), records)
+        totals = expect.sum(axis=1, keepdims=True)
+        return np.where(totals > 0, expect / np.where(totals > 0, totals, 1),
+                        mat), loglik
+
+    with profiling.stage('em'):
+        last = -np.inf
+        success, message = False, 'Maximum number of iterations reached'
+        for nit in range(1, max_iter + 1):
+            # SQUAREM: extrapolate along two EM steps, fall back to plain EM
+            # if the extrapolation decreases likelihood
+            mat1, loglik = em_step(mat)
+            if abs(loglik - last) <= tol * max(abs(loglik), 1):
+                success, message = True, 'Log-likelihood converged'
+                break
+            last = loglik
+            mat2, _ = em_step(mat1)
+            r, v = mat1 - mat, mat2 - 2 * mat1 + mat
+            alpha = -np.sqrt(np.sum(r ** 2) / max(np.sum(v ** 2), 1e-300))
+            jump = mat2
+            while alpha < -1:
+                # step back towards mat2 (alpha = -1) until it is valid
+                jump = mat - 2 * alpha * r + alpha ** 2 * v
+                if np.all(jump[mask] > 0):
+                    break
+                alpha = (alpha - 1) / 2
+                jump = mat2
+            jump /= jump.sum(axis=1, keepdims=True)
+            mat_jump, loglik_jump = em_step(jump)
+            mat = mat_jump if loglik_jump >= loglik else mat2
+        nfev = 3 * nit - 2 if success else 3 * nit
+        profiling.record(evaluations=nfev, iterations=nit,
+                         loss=float(-loglik))
+    model = Model(mat)
+    result = OptimizeResult(
+        x=mat[mask], fun=-loglik, nit=nit, nfev=nfev,
+        success=success, message=message)
+    return model, result
+
+
+def build_models(n_state: int, groups: Dict[str, Records],
+                 jobs: int = 1, build=build_simple_model) \
+        -> Dict[str, tuple]:
+    """Train one model for each group of records, on `jobs` processes
+    (all CPUs if 0). `build` is the picklable function to train model.
+    Return {group: (model, result)} like `build_simple_model`.
+    """
+    counts = {name: TransitionCounts.from_records(n_state, records)
+              if not isinstance(records, TransitionCounts) else records
+              for name, records in groups.items()}
+    jobs = min(jobs or os.cpu_count(), max(len(counts), 1))
+    if jobs <= 1:
+        results = {}
+        for name, c in counts.items():
+            with profiling.stage(f'group {name}'):
+                results[name] = build(n_state, c)
+        return results
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {name: executor.submit(build, n_state, c)
+                   for name, c in counts.items()}
+        return {name: future.result() for name, future in futures.items()}